@@ -1,7 +1,12 @@
 import logging
+from bson import json_util
 from falcon_cors import CORS
+from lib.amqp import Client, Server
 from lib.api import CustomAPI, ApiRequest
+from lib.codec import BSONCodec
 from lib.config import Config
+from lib.httpcache import HttpCacheMiddleware
+from lib import denorm
 
 logging.basicConfig(level='DEBUG',
                     format=u'%(filename)s[LINE:%(lineno)d]# %(levelname)-8s [%(asctime)s]  %(message)s')
@@ -9,11 +14,37 @@ logger = logging.getLogger(__name__)
 
 config = Config()
 
+amqp_options = {
+    'host': config.get('AMQP_HOST', 'localhost'),
+    'user': config.get('AMQP_USER', 'guest'),
+    'password': config.get('AMQP_PASSWORD', 'guest'),
+    'vhost': config.get('AMQP_VHOST', '/'),
+}
+
+if config.get_as_bool('DENORM_ASYNC', False):
+    denorm.enable_async(lambda: Client('denorm', dumper=json_util, codec=BSONCodec(), **amqp_options))
+
+
+def denorm_consumer(window=None):
+    # обработчик ждет применения пачки, поэтому одновременно ждут до prefetch_count сообщений
+    server = Server(
+        'denorm', threaded=True, prefetch_count=config.get_as_int('DENORM_PREFETCH', 200), dumper=json_util,
+        **amqp_options
+    )
+    return denorm.DenormWorker(server, window=float(config.get('DENORM_WINDOW', 0.5)) if window is None else window)
+
+
+# потребители для runconsumers: имя -> фабрика объекта со start/stop
+consumers = {
+    'denorm': denorm_consumer,
+}
+
 api = CustomAPI(request_type=ApiRequest, middleware=[
     CORS(
         allow_all_origins=True,
         allow_all_headers=True,
         allow_all_methods=True,
         allow_credentials_all_origins=True
-    ).middleware
+    ).middleware,
+    HttpCacheMiddleware(),
 ])
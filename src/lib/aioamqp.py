@@ -0,0 +1,112 @@
+import asyncio
+import functools
+import inspect
+import threading
+import time
+from concurrent import futures
+
+from lib.amqp import CallTimeoutError, Client, Engine, Server
+
+
+class LoopEngine(Engine):
+    """
+    Выполняет endpoint-корутины на event loop (свой loop в отдельном потоке, если не передан),
+    одновременно не больше workers. Обычные функции вызываются прямо в loop и не должны блокировать
+    """
+
+    def __init__(self, workers=1000, loop=None):
+        self.workers = workers
+        self.active = 0
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever)
+            thread.daemon = True
+            thread.start()
+            self._own_loop = True
+        else:
+            self._own_loop = False
+        self.loop = loop
+
+    async def _run(self, endpoint, args, kwargs):
+        self.active += 1
+        started = time.time()
+        try:
+            result = endpoint(*args, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+            return result, time.time() - started
+        finally:
+            self.active -= 1
+
+    def execute(self, endpoint, args, kwargs):
+        return asyncio.run_coroutine_threadsafe(self._run(endpoint, args, kwargs), self.loop)
+
+    def submit(self, fn, *args, **kwargs):
+        future = futures.Future()
+
+        def run():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+        self.loop.call_soon_threadsafe(run)
+        return future
+
+    def shutdown(self, wait=True):
+        if self._own_loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class AsyncServer(Server):
+    """
+    Server с endpoint-корутинами: сообщения читаются и подтверждаются в потоке чтения,
+    а обработчики выполняются в event loop, до prefetch_count одновременно
+    """
+
+    def __init__(self, name='', loop=None, prefetch_count=1000, **kwargs):
+        if kwargs.get('engine') is None:
+            kwargs['engine'] = LoopEngine(prefetch_count, loop)
+        super(AsyncServer, self).__init__(name, prefetch_count=prefetch_count, **kwargs)
+
+    async def run(self):
+        """
+        Запускает поток чтения из корутины, обработчики выполняются в loop, переданном в конструктор
+        """
+        await asyncio.get_event_loop().run_in_executor(None, self.start)
+
+
+class AsyncClient(object):
+    """
+    Асинхронный интерфейс к Client: call/publish - корутины, ответы приходят через общую очередь ответов Client,
+    поэтому одновременных вызовов может быть сколько угодно. Отправка выполняется в executor, чтобы не блокировать loop.
+    Loop не привязывается к клиенту: используется тот, в котором выполняется вызов
+    """
+
+    def __init__(self, name, executor=None, **kwargs):
+        self.client = Client(name, **kwargs)
+        self.executor = executor or futures.ThreadPoolExecutor(4)
+
+    async def request(self, key, args=(), kwargs=None, timeout=None, correlation_id=None):
+        timeout = self.client.timeout if timeout is None else timeout
+        # внутри корутины get_event_loop возвращает работающий loop
+        loop = asyncio.get_event_loop()
+        future = await loop.run_in_executor(
+            self.executor, functools.partial(self.client.request, key, args, kwargs, timeout, correlation_id)
+        )
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future, loop=loop), timeout)
+        except asyncio.TimeoutError:
+            self.client.replies.discard(future.correlation_id)
+            raise CallTimeoutError('No reply with correlation id {} in {}s'.format(future.correlation_id, timeout))
+
+    async def call(self, key, *args, **kwargs):
+        return await self.request(key, args, kwargs)
+
+    async def publish(self, _name, *args, **kwargs):
+        await asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(self.client.publish, _name, *args, **kwargs)
+        )
+
+    def close(self):
+        self.client.close()
+        self.executor.shutdown(False)
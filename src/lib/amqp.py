@@ -1,17 +1,293 @@
+import collections
+import contextlib
+import hashlib
+import itertools
 import json
 import logging
+import multiprocessing
+import os
 import re
+import socket
 import threading
 import uuid
 import amqp
+import six
 import time
+from bson import json_util
+from concurrent import futures
+
+from lib.cache import LRUCache, MemcacheCache
+from lib.codec import MessageCodec
+from lib.config import Config
 
 logger = logging.getLogger(__name__)
 
 
+class CallTimeoutError(socket.timeout):
+    pass
+
+
+class RequeueError(Exception):
+    """
+    Ошибка endpoint, после которой сообщение возвращается в очередь, а не отбрасывается
+    """
+
+
+class RPCFuture(futures.Future):
+    """
+    Future ответа на Client.call_async, по истечении таймаута ожидание ответа снимается
+    """
+
+    def __init__(self, replies, correlation_id, timeout):
+        super(RPCFuture, self).__init__()
+        self.replies = replies
+        self.correlation_id = correlation_id
+        self.timeout = timeout
+
+    def result(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return super(RPCFuture, self).result(timeout)
+        except futures.TimeoutError:
+            self.replies.discard(self.correlation_id)
+            raise CallTimeoutError('No reply with correlation id {} in {}s'.format(self.correlation_id, timeout))
+
+
+class ReplyConsumer(object):
+    """
+    Одна долгоживущая exclusive очередь ответов на клиента и поток, который читает ее на своем соединении
+    и раздает ответы ожидающим Future по correlation_id
+    """
+
+    def __init__(self, connection_factory, loads, poll_interval=1):
+        self.connection_factory = connection_factory
+        self.loads = loads
+        self.poll_interval = poll_interval
+        self.pending = {}
+        self.queue = None
+        self.lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopped = False
+
+    def _is_running(self):
+        return self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+
+    def ensure_started(self):
+        if self._is_running():
+            return self.queue
+        with self.lock:
+            if self._is_running():
+                return self.queue
+            if self._pid != os.getpid():
+                self.pending = {}
+            connection = self.connection_factory()
+            channel = connection.channel()
+            self.queue = channel.queue_declare(exclusive=True).queue
+            channel.basic_consume(self.queue, callback=self._on_reply, no_ack=True)
+            self._pid = os.getpid()
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, args=(connection,))
+            self._thread.daemon = True
+            self._thread.start()
+            logger.debug('Waiting for replies in queue %s', self.queue)
+            return self.queue
+
+    def _run(self, connection):
+        while not self._stopped:
+            try:
+                connection.drain_events(self.poll_interval)
+            except socket.timeout:
+                continue
+            except Exception as e:
+                logger.error(e)
+                self._fail_pending(e)
+                break
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _fail_pending(self, error):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(error)
+
+    def register(self, correlation_id, future):
+        with self.lock:
+            self.pending[correlation_id] = future
+
+    def discard(self, correlation_id):
+        with self.lock:
+            self.pending.pop(correlation_id, None)
+
+    def _on_reply(self, message):
+        correlation_id = message.properties.get('correlation_id')
+        with self.lock:
+            future = self.pending.pop(correlation_id, None)
+        if future is None:
+            logger.debug('Reply with unknown correlation id %s dropped', correlation_id)
+            return
+        logger.debug('Reply %s with correlation id %s received', message.body, correlation_id)
+        try:
+            future.set_result(self.loads(message))
+        except Exception as e:
+            future.set_exception(e)
+
+    def close(self):
+        self._stopped = True
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class ChannelPool(object):
+    """
+    Пул пар (соединение, канал) для публикации из любых потоков.
+    Соединения создаются лениво (не больше size), перед выдачей проверяются,
+    после fork пул начинается заново (соединения родителя не трогаются)
+    """
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, connection_factory, size=10, timeout=10):
+        self.connection_factory = connection_factory
+        self.size = size
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = collections.deque()
+        self._live = 0
+        self.stats = {
+            'created': 0,
+            'reused': 0,
+            'discarded': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'in_use': 0,
+        }
+
+    @classmethod
+    def for_credentials(cls, credentials):
+        key = tuple(sorted(credentials.items()))
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if pool is None:
+                config = Config()
+                pool = cls._pools[key] = cls(
+                    lambda: amqp.Connection(**credentials),
+                    size=config.get_as_int('AMQP_POOL_SIZE', 10),
+                    timeout=config.get_as_int('AMQP_POOL_TIMEOUT', 10)
+                )
+            return pool
+
+    @classmethod
+    def reset_all(cls):
+        with cls._pools_lock:
+            for pool in cls._pools.values():
+                with pool._cond:
+                    pool._reset()
+
+    def _healthy(self, item):
+        connection, channel = item
+        try:
+            return channel.is_open and connection.connected and connection.is_alive()
+        except Exception:
+            return False
+
+    def _close(self, item):
+        connection, channel = item
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def checkout(self):
+        started = time.time()
+        with self._cond:
+            if self._pid != os.getpid():
+                self._reset()
+            waited = False
+            while True:
+                while self._idle:
+                    item = self._idle.pop()
+                    if self._healthy(item):
+                        self.stats['reused'] += 1
+                        self.stats['checkouts'] += 1
+                        self.stats['in_use'] += 1
+                        return item
+                    self._live -= 1
+                    self.stats['discarded'] += 1
+                    self._close(item)
+                if self._live < self.size:
+                    self._live += 1
+                    break
+                if not waited:
+                    waited = True
+                    self.stats['waits'] += 1
+                remaining = None if self.timeout is None else self.timeout - (time.time() - started)
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeoutError('No free AMQP channel in {}s'.format(self.timeout))
+                self._cond.wait(remaining)
+            if waited:
+                self.stats['wait_time'] += time.time() - started
+        try:
+            connection = self.connection_factory()
+            item = (connection, connection.channel())
+        except Exception:
+            with self._cond:
+                self._live -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.stats['created'] += 1
+            self.stats['checkouts'] += 1
+            self.stats['in_use'] += 1
+        return item
+
+    def checkin(self, item, discard=False):
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self.stats['in_use'] -= 1
+            if discard:
+                self._live -= 1
+                self.stats['discarded'] += 1
+                self._close(item)
+            else:
+                self._idle.append(item)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def channel(self):
+        item = self.checkout()
+        try:
+            yield item[1]
+        except Exception:
+            self.checkin(item, discard=True)
+            raise
+        self.checkin(item)
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats.update(size=self.size, live=self._live, idle=len(self._idle))
+            return stats
+
+
 class Client(object):
     def __init__(self, name, prefix='am', host='localhost', user='guest', password='guest', vhost='/', timeout=5,
-                 dumper=None, exchange_type='topic'):
+                 dumper=None, exchange_type='topic', connection_factory=None, codec=None, compress_threshold=None):
+        """
+        codec - lib.codec.JSONCodec (по умолчанию, через dumper) или BSONCodec,
+        тела длиннее compress_threshold байт сжимаются zlib
+        """
         if not prefix.endswith('_'):
             prefix += '_'
         if len(name) > 0 and not name.endswith('_'):
@@ -25,70 +301,508 @@ class Client(object):
         if dumper is None:
             dumper = json
         self.dumper = dumper
+        self.codec = MessageCodec(codec, dumper, compress_threshold)
         self.timeout = timeout
         self.prefix = prefix
         self.name = name
         self.exchange_name = self.prefix + 'exchange_' + exchange_type
         self.exchange_type = exchange_type
-        self.connection = None
-        self.channel = None
+        self.connection_factory = connection_factory or (lambda: amqp.Connection(**self.credentials))
+        self.pool = None if connection_factory is None else ChannelPool(connection_factory)
+        self.replies = ReplyConsumer(self.connection_factory, lambda message: self.codec.decode(message)[0])
         self.connect()
 
     def connect(self):
-        self.connection = amqp.Connection(**self.credentials)
-        self.channel = self.connection.channel()
+        """
+        Соединения берутся из общего пула по реквизитам и открываются лениво
+        """
+        if self.pool is None:
+            self.pool = ChannelPool.for_credentials(self.credentials)
 
     def close(self):
-        self.channel.close()
-        # self.connection.close()
+        self.replies.close()
 
-    def call(self, key, *args, **kwargs):
-        correlation_id = str(uuid.uuid4())
-        reply = self.channel.queue_declare(exclusive=True).queue
-        routing_key = (self.prefix + self.name).replace('_', '.') + key
-        body = self.dumper.dumps({'args': args, 'kwargs': kwargs})
-        self.channel.basic_publish(
-            amqp.Message(body, reply_to=reply, correlation_id=correlation_id),
-            self.exchange_name, routing_key=routing_key,
+    def routing_key(self, key):
+        return (self.prefix + self.name).replace('_', '.') + key
 
-        )
+    def _publish(self, message, routing_key):
+        with self.pool.channel() as channel:
+            channel.basic_publish(message, self.exchange_name, routing_key=routing_key)
+
+    def request(self, key, args=(), kwargs=None, timeout=None, correlation_id=None):
+        """
+        Отправляет вызов и сразу возвращает RPCFuture,
+        result() ждет ответ не дольше timeout (по умолчанию self.timeout).
+        Вызовы из разных потоков идут параллельно через общую очередь ответов
+        """
+        correlation_id = correlation_id or str(uuid.uuid4())
+        reply = self.replies.ensure_started()
+        future = RPCFuture(self.replies, correlation_id, self.timeout if timeout is None else timeout)
+        self.replies.register(correlation_id, future)
+        routing_key = self.routing_key(key)
+        body, properties = self.codec.encode({'args': args, 'kwargs': kwargs or {}})
+        try:
+            self._publish(amqp.Message(body, reply_to=reply, correlation_id=correlation_id, **properties), routing_key)
+        except Exception:
+            self.replies.discard(correlation_id)
+            raise
         logger.debug('Message %s with routing key %s published', body, routing_key)
         logger.debug('Waiting for reply in queue %s with correlation id %s', reply, correlation_id)
+        return future
 
-        message = {}
-
-        def _reply(_message):
-            logger.debug(
-                'Reply %s with correlation id %s received', _message.body, _message.properties['correlation_id']
-            )
-            if _message.properties['correlation_id'] == correlation_id:
-                message['result'] = self.dumper.loads(_message.body)
-                self.channel.basic_ack(_message.delivery_tag)
+    def call_async(self, key, *args, **kwargs):
+        return self.request(key, args, kwargs)
 
-        while True:
-            self.channel.basic_consume(reply, callback=_reply)
-            self.connection.drain_events(self.timeout)
-            if 'result' in message:
-                return message['result']
+    def call(self, key, *args, **kwargs):
+        return self.request(key, args, kwargs).result()
 
     def publish(self, _name, *args, **kwargs):
-        routing_key = (self.prefix + self.name).replace('_', '.') + _name
-        body = self.dumper.dumps({'args': args, 'kwargs': kwargs})
-        self.channel.basic_publish(amqp.Message(body), self.exchange_name, routing_key=routing_key)
+        routing_key = self.routing_key(_name)
+        body, properties = self.codec.encode({'args': args, 'kwargs': kwargs})
+        self._publish(amqp.Message(body, **properties), routing_key)
         logger.debug('Message %s with routing key %s published', body, routing_key)
 
 
+class BufferedPublisher(object):
+    """
+    Публикация событий пачками: сообщения копятся в буфере и отправляются из отдельного потока
+    раз в flush_interval секунд или по batch_size штук, по своему соединению с publisher confirms.
+    Неподтвержденных брокером сообщений не больше window, дальше publish блокируется.
+    Отклоненные брокером (nack) и оставшиеся без подтверждения при обрыве соединения сообщения
+    отправляются повторно, поэтому возможны дубли
+    """
+
+    def __init__(self, client, batch_size=100, flush_interval=0.05, window=1000, poll_interval=0.01):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.window = window
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._buffer = collections.deque()
+        # отправляемая сейчас пачка и отправленные без подтверждения: номер -> (время отправки, сообщение)
+        self._sending = collections.deque()
+        self._outstanding = collections.OrderedDict()
+        self._slots = threading.BoundedSemaphore(self.window)
+        self._stopped = False
+        self._thread = None
+        self._started = time.time()
+        self.stats = {
+            'published': 0,
+            'confirmed': 0,
+            'nacked': 0,
+            'republished': 0,
+            'batches': 0,
+            'confirm_time': 0.0,
+            'confirm_time_max': 0.0,
+        }
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._pid != os.getpid():
+                self._reset()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def publish(self, _name, *args, **kwargs):
+        self._ensure_started()
+        body, properties = self.client.codec.encode({'args': args, 'kwargs': kwargs})
+        self._slots.acquire()
+        with self._cond:
+            self._buffer.append((self.client.routing_key(_name), body, properties))
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _confirm(self, delivery_tag, multiple, nacked=False):
+        now = time.time()
+        with self._cond:
+            if multiple:
+                tags = list(itertools.takewhile(lambda i: i <= delivery_tag, self._outstanding))
+            else:
+                tags = [delivery_tag]
+            rejected = []
+            for tag in tags:
+                item = self._outstanding.pop(tag, None)
+                if item is None:
+                    continue
+                sent, message = item
+                if nacked:
+                    # слот окна остается занятым до подтверждения повторной отправки
+                    rejected.append(message)
+                    continue
+                self.stats['confirmed'] += 1
+                self.stats['confirm_time'] += now - sent
+                self.stats['confirm_time_max'] = max(self.stats['confirm_time_max'], now - sent)
+                self._slots.release()
+            if rejected:
+                self.stats['nacked'] += len(rejected)
+                self._requeue(rejected)
+            self._cond.notify_all()
+        if nacked:
+            logger.warning('Broker nacked %s message(s) up to delivery tag %s, republishing', len(tags), delivery_tag)
+
+    def _requeue(self, messages):
+        self._buffer.extendleft(reversed(messages))
+        self.stats['republished'] += len(messages)
+
+    def _on_nack(self, delivery_tag, multiple, requeue=False):
+        self._confirm(delivery_tag, multiple, nacked=True)
+
+    def _connect(self):
+        connection = self.client.connection_factory()
+        channel = connection.channel()
+        channel.confirm_select()
+        channel.events['basic_ack'].add(self._confirm)
+        channel.events['basic_nack'].add(self._on_nack)
+        return connection, channel
+
+    def _take(self):
+        with self._cond:
+            if len(self._buffer) < self.batch_size and not self._outstanding and not self._stopped:
+                self._cond.wait(self.flush_interval)
+            while self._buffer and len(self._sending) < self.batch_size:
+                self._sending.append(self._buffer.popleft())
+            return self._sending
+
+    def _run(self):
+        connection = channel = None
+        sequence = 0
+        while True:
+            try:
+                if connection is None:
+                    connection, channel = self._connect()
+                    sequence = 0
+                batch = self._take()
+                if batch:
+                    self.stats['batches'] += 1
+                while batch:
+                    routing_key, body, properties = batch[0]
+                    channel.basic_publish(
+                        amqp.Message(body, **properties), self.client.exchange_name, routing_key=routing_key
+                    )
+                    sequence += 1
+                    with self._cond:
+                        self._outstanding[sequence] = (time.time(), batch.popleft())
+                        self.stats['published'] += 1
+                with self._cond:
+                    if self._stopped and not self._buffer and not self._outstanding:
+                        break
+                    outstanding = bool(self._outstanding)
+                if outstanding:
+                    try:
+                        connection.drain_events(timeout=self.poll_interval)
+                    except socket.timeout:
+                        pass
+            except Exception as e:
+                logger.error('Buffered publisher failed: %s', e)
+                with self._cond:
+                    # подтверждения старого соединения уже не придут: отправленное без них уходит заново
+                    # перед неотправленным остатком пачки, слоты окна остаются занятыми
+                    self._buffer.extendleft(reversed(self._sending))
+                    self._sending.clear()
+                    self._requeue([message for _, message in self._outstanding.values()])
+                    self._outstanding.clear()
+                    self._cond.notify_all()
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+                connection = channel = None
+                time.sleep(1)
+        connection.close()
+
+    def flush(self, timeout=None):
+        """
+        Ждет, пока все накопленные сообщения будут отправлены и подтверждены
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._buffer or self._sending or self._outstanding:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining if remaining is not None else self.flush_interval)
+        return True
+
+    def close(self, timeout=None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and self._pid == os.getpid():
+            thread.join(timeout)
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats.update(
+                buffered=len(self._buffer) + len(self._sending),
+                outstanding=len(self._outstanding),
+                throughput=stats['confirmed'] / max(time.time() - self._started, 1e-9),
+                confirm_time_avg=stats['confirm_time'] / stats['confirmed'] if stats['confirmed'] else 0.0,
+            )
+            return stats
+
+
+class CachePolicy(object):
+    """
+    Кеш результатов endpoint для Server.register_endpoint(..., cache=CachePolicy(...)):
+    результат запоминается по (ключ маршрутизации, хеш аргументов) на ttl секунд (ttl=None - не запоминается),
+    с dedupe повторное сообщение с тем же correlation_id (повторная доставка, retry клиента)
+    получает сохраненный ответ без выполнения. backend - 'local' (LRU процесса), 'memcache' или объект кеша
+    """
+
+    def __init__(self, ttl=60, backend='local', dedupe=True, dedupe_ttl=None, maxsize=1024):
+        self.ttl = ttl
+        self.dedupe = dedupe
+        self.dedupe_ttl = dedupe_ttl or ttl or 60
+        if backend == 'local':
+            backend = LRUCache(maxsize)
+        elif backend == 'memcache':
+            backend = MemcacheCache(prefix='rpc:')
+        self.cache = backend
+
+    def keys(self, routing_key, correlation_id, args, kwargs):
+        """
+        [(ключ, ttl)] для поиска и сохранения результата
+        """
+        keys = []
+        if self.dedupe and correlation_id:
+            keys.append(('c:{}:{}'.format(routing_key, correlation_id), self.dedupe_ttl))
+        if self.ttl:
+            try:
+                encoded = json_util.dumps([args, kwargs], sort_keys=True)
+            except (TypeError, ValueError):
+                logger.debug('Arguments for %s are not cacheable', routing_key)
+            else:
+                keys.append(('a:{}:{}'.format(routing_key, hashlib.md5(encoded.encode('utf-8')).hexdigest()), self.ttl))
+        return keys
+
+    def get(self, keys):
+        """
+        (найдено, результат)
+        """
+        found = self.cache.get_many([key for key, ttl in keys]) if keys else {}
+        for key, ttl in keys:
+            if key in found:
+                return True, found[key]
+        return False, None
+
+    def set(self, keys, result):
+        for key, ttl in keys:
+            self.cache.set(key, result, ttl)
+
+
+class _TopicNode(object):
+    __slots__ = ('children', 'patterns', 'star', 'hash', 'endpoint')
+
+    def __init__(self):
+        self.children = {}
+        self.patterns = {}
+        self.star = None
+        self.hash = None
+        self.endpoint = None
+
+
+class TopicTrie(object):
+    """
+    Дерево сегментов ключей маршрутизации: '*' - ровно один сегмент, '#' - ноль или больше сегментов,
+    сегмент со '*' внутри (например 'get_*') проверяется регулярным выражением.
+    Из нескольких подходящих ключей выбирается зарегистрированный раньше, результаты кешируются по ключу
+    """
+
+    def __init__(self, cache_size=1024):
+        self.root = _TopicNode()
+        self.count = 0
+        self.cache = LRUCache(cache_size)
+
+    def add(self, key, value):
+        node = self.root
+        for segment in key.split('.'):
+            if segment == '#':
+                node.hash = node.hash or _TopicNode()
+                node = node.hash
+            elif segment == '*':
+                node.star = node.star or _TopicNode()
+                node = node.star
+            elif '*' in segment:
+                if segment not in node.patterns:
+                    pattern = '[^.]*'.join([re.escape(i) for i in segment.split('*')])
+                    node.patterns[segment] = (re.compile(r'^{}$'.format(pattern)), _TopicNode())
+                node = node.patterns[segment][1]
+            else:
+                node = node.children.setdefault(segment, _TopicNode())
+        if node.endpoint is None:
+            node.endpoint = (self.count, key, value)
+        self.count += 1
+        self.cache.clear()
+
+    def _match(self, segments):
+        best = None
+        size = len(segments)
+        seen = set()
+        stack = [(self.root, 0)]
+        while stack:
+            node, i = stack.pop()
+            if (id(node), i) in seen:
+                continue
+            seen.add((id(node), i))
+            if node.hash is not None:
+                stack.extend((node.hash, j) for j in range(i, size + 1))
+            if i == size:
+                if node.endpoint is not None and (best is None or node.endpoint[0] < best[0]):
+                    best = node.endpoint
+                continue
+            segment = segments[i]
+            child = node.children.get(segment)
+            if child is not None:
+                stack.append((child, i + 1))
+            if node.star is not None:
+                stack.append((node.star, i + 1))
+            for pattern, child in node.patterns.values():
+                if pattern.match(segment):
+                    stack.append((child, i + 1))
+        return best
+
+    def match(self, routing_key):
+        """
+        (key, value) первого зарегистрированного подходящего ключа или (None, None)
+        """
+        result = self.cache.get(routing_key)
+        if result is None:
+            best = self._match(routing_key.split('.'))
+            result = (None, None) if best is None else best[1:]
+            self.cache.set(routing_key, result)
+        return result
+
+
+def _timed_call(endpoint, args, kwargs):
+    started = time.time()
+    return endpoint(*args, **kwargs), time.time() - started
+
+
+class Engine(object):
+    """
+    Исполнитель обработчиков Server: submit(fn, *args, **kwargs) возвращает concurrent.futures.Future,
+    workers - сколько сообщений Server держит в работе одновременно, active - сколько выполняется сейчас
+    """
+    workers = 1
+    active = 0
+
+    def submit(self, fn, *args, **kwargs):
+        raise NotImplementedError
+
+    def execute(self, endpoint, args, kwargs):
+        """
+        Future с (результат, время выполнения)
+        """
+        return self.submit(_timed_call, endpoint, args, kwargs)
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class InlineEngine(Engine):
+    """
+    Выполняет обработчик сразу в потоке чтения
+    """
+
+    def __init__(self):
+        self.active = 0
+
+    def submit(self, fn, *args, **kwargs):
+        future = futures.Future()
+        self.active += 1
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            self.active -= 1
+        return future
+
+
+class ThreadEngine(Engine):
+    """
+    Ограниченный пул потоков, active - сколько обработчиков выполняется прямо сейчас
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.active = 0
+        self._lock = threading.Lock()
+        self._executor = futures.ThreadPoolExecutor(workers)
+
+    def _run(self, fn, args, kwargs):
+        with self._lock:
+            self.active += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(self._run, fn, args, kwargs)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+
+class ProcessEngine(Engine):
+    """
+    Пул процессов для CPU-bound обработчиков, обработчик и аргументы должны сериализоваться pickle
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._executor = futures.ProcessPoolExecutor(self.workers)
+
+    @property
+    def active(self):
+        return min(self.in_flight, self.workers)
+
+    def _done(self, future):
+        with self._lock:
+            self.in_flight -= 1
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+        future = self._executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+
 def run_server(server):
-    try:
-        server.start()
-    except KeyboardInterrupt:
-        server.channel.close()
-        server.connection.close()
+    server.start()
 
 
 class Server(object):
+    """
+    Сообщения читаются и подтверждаются только в потоке чтения (start), обработчики выполняются в engine:
+    без threaded - сразу в потоке чтения, с threaded - в пуле из prefetch_count потоков,
+    endpoint с cpu_bound=True - в пуле процессов. Ack (или reject без возврата в очередь при ошибке)
+    и ответ отправляются после завершения обработчика
+    """
+
     def __init__(self, name='', prefix='am', threaded=False, host='localhost', user='guest', password='guest',
-                 vhost='/', dumper=None, exchange_type='topic', prefetch_count=5):
+                 vhost='/', dumper=None, exchange_type='topic', prefetch_count=5, connection_factory=None,
+                 engine=None, process_workers=None, poll_interval=1, busy_poll_interval=0.01, route_cache_size=1024,
+                 codec=None, compress_threshold=None, drain_timeout=30, reconnect_delay=5):
         if not prefix.endswith('_'):
             prefix += '_'
         if len(name) > 0 and not name.endswith('_'):
@@ -102,6 +816,7 @@ class Server(object):
         if dumper is None:
             dumper = json
         self.dumper = dumper
+        self.codec = MessageCodec(codec, dumper, compress_threshold)
         self.prefix = prefix
         self.prefetch_count = prefetch_count
         self.name = name
@@ -112,14 +827,63 @@ class Server(object):
         self.channel = None
         self.exchange_type = exchange_type
         self.endpoints = []
+        self.routes = TopicTrie(route_cache_size)
+        self.cpu_bound = set()
+        self.cache_policies = {}
+        self.running = {}
+        self.connection_factory = connection_factory or (lambda: amqp.Connection(**self.credentials))
+        if engine is None:
+            engine = ThreadEngine(prefetch_count) if threaded else InlineEngine()
+        self.engine = engine
+        self.process_engine = None
+        self.process_workers = process_workers
+        self.poll_interval = poll_interval
+        self.busy_poll_interval = busy_poll_interval
+        self.drain_timeout = drain_timeout
+        self.reconnect_delay = reconnect_delay
+        self.stopping = False
+        self.consumer_tags = []
+        self.in_flight = 0
+        self.completions = six.moves.queue.Queue()
+        self.stats = {
+            'received': 0,
+            'cache_hits': 0,
+            'deduplicated': 0,
+            'completed': 0,
+            'handled': 0,
+            'acked': 0,
+            'rejected': 0,
+            'requeued': 0,
+            'handler_time': 0.0,
+            'handler_time_max': 0.0,
+            'latency': 0.0,
+            'latency_max': 0.0,
+        }
 
-    def register_endpoint(self, key, endpoint):
+    @property
+    def capacity(self):
+        """
+        Сколько сообщений может быть в обработке, пока поток чтения продолжает читать: обработчики обоих engine
+        и не меньше prefetch_count, больше брокер все равно не пришлет
+        """
+        workers = self.engine.workers
+        if self.process_engine is not None:
+            workers += self.process_engine.workers
+        return max(workers, self.prefetch_count or 0, 1)
+
+    def register_endpoint(self, key, endpoint, cpu_bound=False, cache=None):
         key = (self.prefix + self.name).replace('_', '.') + key
-        pattern = '[^.]*'.join([re.escape(i) for i in key.split('*')])
-        self.endpoints.append((key, re.compile(r'^{}$'.format(pattern)), endpoint))
+        self.endpoints.append((key, endpoint))
+        self.routes.add(key, endpoint)
+        if cache is not None:
+            self.cache_policies[key] = cache
+        if cpu_bound:
+            self.cpu_bound.add(key)
+            if self.process_engine is None:
+                self.process_engine = ProcessEngine(self.process_workers)
 
     def connect(self):
-        self.connection = amqp.Connection(**self.credentials)
+        self.connection = self.connection_factory()
         self.channel = self.connection.channel()
         self.channel.exchange_declare(self.exchange_name, self.exchange_type)
         self.channel.basic_qos(0, self.prefetch_count, False)
@@ -130,66 +894,201 @@ class Server(object):
         self.prepare_queues()
 
     def prepare_queues(self):
-        for key, pattern, endpoint in self.endpoints:
+        for key, endpoint in self.endpoints:
             self.channel.queue_bind(self.queue_name, self.exchange_name, routing_key=key)
             if self.exchange_type == 'fanout':
-                self.channel.basic_consume(self.queue_name, callback=self.consume, no_ack=True)
+                tag = self.channel.basic_consume(self.queue_name, callback=self.consume, no_ack=True)
             else:
-                self.channel.basic_consume(self.queue_name, callback=self.consume)
+                tag = self.channel.basic_consume(self.queue_name, callback=self.consume)
+            self.consumer_tags.append(tag)
             logger.debug('Endpoint %s bound to %s', key, self.queue_name)
 
-    def handle(self, message):
-        logger.debug('Starting execution')
-        for key, pattern, endpoint in self.endpoints:
-            if pattern.match(message.delivery_info['routing_key']):
-                try:
-                    msg = self.dumper.loads(message.body)
-                    result = endpoint(*msg.get('args', []), **msg.get('kwargs', {}))
-                    if self.exchange_type != 'fanout':
-                        message.channel.basic_ack(message.delivery_tag)
-                except Exception as e:
-                    logger.error(e)
-                    result = e
-                logger.debug('Execution ended')
-                if message.properties.get('reply_to'):
-                    try:
-                        body = self.dumper.dumps(result)
-                    except Exception:
-                        body = self.dumper.dumps({'error': 'Error dump result'})
-                    logger.debug(
-                        'Sending a reply %s to %s with correlation id %s', body, message.properties['reply_to'],
-                        message.properties['correlation_id']
-                    )
-                    self.channel.basic_publish(
-                        amqp.Message(body, correlation_id=message.properties['correlation_id']),
-                        routing_key=message.properties['reply_to']
-                    )
+    def route(self, routing_key):
+        return self.routes.match(routing_key)
 
     def consume(self, message):
-        logger.debug('Message %s with routing key %s received', message.body, message.delivery_info['routing_key'])
-        if self.threaded:
-            p = threading.Thread(target=self.handle, args=(message,))
-            p.daemon = True
-            p.start()
-        else:
-            self.handle(message)
+        routing_key = message.delivery_info['routing_key']
+        logger.debug('Message %s with routing key %s received', message.body, routing_key)
+        self.stats['received'] += 1
+        received = time.time()
+        key, endpoint = self.route(routing_key)
+        if endpoint is None:
+            logger.warning('No endpoint for routing key %s', routing_key)
+            self.complete(message, received, error=LookupError(routing_key))
+            return
+        try:
+            msg, codec = self.codec.decode(message)
+            args, kwargs = msg.get('args', []), msg.get('kwargs', {})
+        except Exception as e:
+            self.complete(message, received, error=e)
+            return
+        cache, cache_keys = self.cache_policies.get(key), ()
+        if cache is not None:
+            cache_keys = cache.keys(routing_key, message.properties.get('correlation_id'), args, kwargs)
+            hit, result = cache.get(cache_keys)
+            if hit:
+                self.stats['cache_hits'] += 1
+                self.complete(message, received, result, codec=codec)
+                return
+            if cache_keys and cache_keys[-1][0] in self.running:
+                self.stats['deduplicated'] += 1
+                self.running[cache_keys[-1][0]].append((message, received, codec))
+                return
+            if cache_keys:
+                self.running[cache_keys[-1][0]] = []
+        engine = self.process_engine if key in self.cpu_bound else self.engine
+        self.in_flight += 1
+        completions = self.completions
+        future = engine.execute(endpoint, args, kwargs)
+        future.add_done_callback(lambda f: completions.put((message, received, codec, (cache, cache_keys), f)))
 
-    def start(self):
-        logger.debug('Start consuming')
+    def process_completions(self, timeout=None):
+        """
+        Подтверждает завершенные сообщения, с timeout сначала ждет хотя бы одно
+        """
         try:
-            self.connect()
-            while True:
-                self.channel.wait()
-        except KeyboardInterrupt:
-            logger.debug('Stop consuming')
-            self.channel.close()
-            # self.connection.close()
+            item = self.completions.get(timeout=timeout) if timeout else self.completions.get_nowait()
+        except six.moves.queue.Empty:
+            return
+        while True:
+            message, received, codec, (cache, cache_keys), future = item
+            self.in_flight -= 1
+            waiting = self.running.pop(cache_keys[-1][0], []) if cache_keys else []
+            try:
+                result, elapsed = future.result()
+            except Exception as e:
+                for message, received, codec in [(message, received, codec)] + waiting:
+                    self.complete(message, received, error=e, codec=codec)
+            else:
+                self.stats['handled'] += 1
+                self.stats['handler_time'] += elapsed
+                self.stats['handler_time_max'] = max(self.stats['handler_time_max'], elapsed)
+                if cache_keys:
+                    cache.set(cache_keys, result)
+                for message, received, codec in [(message, received, codec)] + waiting:
+                    self.complete(message, received, result, codec=codec)
+            try:
+                item = self.completions.get_nowait()
+            except six.moves.queue.Empty:
+                return
+
+    def reply(self, message, result, codec=None):
+        """
+        Отвечает тем же кодеком, что и запрос, без content_type у запроса - JSON без сжатия
+        """
+        codec = codec or self.codec.legacy
+        compress = message.properties.get('content_type') is not None
+        try:
+            body, properties = self.codec.encode(result, codec, compress)
+        except Exception:
+            body, properties = self.codec.encode({'error': 'Error dump result'}, codec, compress)
+        logger.debug(
+            'Sending a reply %s to %s with correlation id %s', body, message.properties['reply_to'],
+            message.properties['correlation_id']
+        )
+        self.channel.basic_publish(
+            amqp.Message(body, correlation_id=message.properties['correlation_id'], **properties),
+            routing_key=message.properties['reply_to']
+        )
+
+    def complete(self, message, received, result=None, error=None, codec=None):
+        if error is not None:
+            logger.error(error)
+            result = error
+        logger.debug('Execution ended')
+        try:
+            if self.exchange_type != 'fanout':
+                if error is None:
+                    message.channel.basic_ack(message.delivery_tag)
+                    self.stats['acked'] += 1
+                elif isinstance(error, RequeueError):
+                    message.channel.basic_reject(message.delivery_tag, True)
+                    self.stats['requeued'] += 1
+                else:
+                    message.channel.basic_reject(message.delivery_tag, False)
+                    self.stats['rejected'] += 1
+            if message.properties.get('reply_to'):
+                self.reply(message, result, codec)
         except Exception as e:
+            logger.error('Failed to complete message %s: %s', message.delivery_tag, e)
+        latency = time.time() - received
+        self.stats['completed'] += 1
+        self.stats['latency'] += latency
+        self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        active = self.engine.active + (self.process_engine.active if self.process_engine is not None else 0)
+        stats.update(
+            in_flight=self.in_flight,
+            active=active,
+            queue_depth=max(self.in_flight - active, 0),
+            handler_time_avg=stats['handler_time'] / stats['handled'] if stats['handled'] else 0.0,
+            latency_avg=stats['latency'] / stats['completed'] if stats['completed'] else 0.0,
+        )
+        return stats
+
+    def serve(self):
+        while not self.stopping:
+            self.process_completions()
+            if self.in_flight >= self.capacity:
+                self.process_completions(self.poll_interval)
+                continue
             try:
-                self.channel.close()
+                self.connection.drain_events(timeout=self.busy_poll_interval if self.in_flight else self.poll_interval)
+            except socket.timeout:
+                pass
+
+    def stop(self):
+        """
+        Просит start завершиться после drain, можно вызывать из обработчика сигнала
+        """
+        self.stopping = True
+
+    def drain(self):
+        """
+        Отменяет подписки и дожидается подтверждения уже полученных сообщений (не дольше drain_timeout),
+        неподтвержденные сообщения брокер вернет в очередь при закрытии канала
+        """
+        for tag in self.consumer_tags:
+            try:
+                self.channel.basic_cancel(tag)
+            except Exception as e:
+                logger.error(e)
+        self.consumer_tags = []
+        deadline = time.time() + self.drain_timeout
+        while self.in_flight and time.time() < deadline:
+            self.process_completions(self.poll_interval)
+        logger.debug('Drained, %s messages left in flight', self.in_flight)
+
+    def close(self):
+        for resource in (self.channel, self.connection):
+            try:
+                if resource is not None:
+                    resource.close()
             except Exception:
                 pass
-            logger.error(e)
-            logger.debug('Reconnect')
-            time.sleep(5)
-            self.start()
\ No newline at end of file
+        self.channel = self.connection = None
+
+    def start(self):
+        logger.debug('Start consuming')
+        self.stopping = False
+        while not self.stopping:
+            try:
+                self.connect()
+                self.serve()
+                self.drain()
+            except KeyboardInterrupt:
+                logger.debug('Stop consuming')
+                self.stopping = True
+            except Exception as e:
+                logger.error(e)
+                if not self.stopping:
+                    logger.debug('Reconnect in %ss', self.reconnect_delay)
+                    time.sleep(self.reconnect_delay)
+            finally:
+                self.close()
+                self.in_flight = 0
+                self.running = {}
+                self.completions = six.moves.queue.Queue()
+        logger.debug('Stop consuming')
@@ -1,6 +1,9 @@
 import falcon
 from falcon import Request
 
+from lib.deref import DerefLoader
+from lib.parser import warm_up_schemas
+
 
 class CustomAPI(falcon.API):
     def __init__(self, *args, **kwargs):
@@ -11,8 +14,20 @@ class CustomAPI(falcon.API):
         self.routes.append((uri_template, resource))
         super(CustomAPI, self).add_route(uri_template, resource, *args, **kwargs)
 
+    def warm_up(self):
+        return warm_up_schemas(self.routes)
+
 
 class ApiRequest(Request):
     def __init__(self, env, options=None):
         super(ApiRequest, self).__init__(env, options)
-        self.context = {}
\ No newline at end of file
+        self.context = {}
+
+    @property
+    def deref(self):
+        """
+        :rtype: lib.deref.DerefLoader
+        """
+        if 'deref' not in self.context:
+            self.context['deref'] = DerefLoader()
+        return self.context['deref']
@@ -0,0 +1,267 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from pymemcache.client.base import Client as MemcacheClient
+from pymemcache.client.hash import HashClient
+
+from lib.config import Config
+
+logger = logging.getLogger(__name__)
+
+_missing = object()
+
+
+class LRUCache(object):
+    """
+    Потокобезопасный LRU кеш внутри процесса с необязательным TTL (в секундах)
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, key, now):
+        item = self._data.get(key, _missing)
+        if item is _missing:
+            return _missing
+        value, expires = item
+        if expires is not None and expires < now:
+            del self._data[key]
+            return _missing
+        self._data.move_to_end(key)
+        return value
+
+    def _set(self, key, value, ttl, now):
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (value, now + ttl if ttl else None)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._get(key, time.time())
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def get_many(self, keys):
+        result = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                value = self._get(key, now)
+                if value is _missing:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    result[key] = value
+        return result
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set(key, value, ttl, time.time())
+
+    def set_many(self, mapping, ttl=None):
+        now = time.time()
+        with self._lock:
+            for key, value in mapping.items():
+                self._set(key, value, ttl, now)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._get(key, time.time()) is not _missing
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def _parse_server(server):
+    host, _, port = server.partition(':')
+    return host, int(port or 11211)
+
+
+_memcache_clients = {}
+_memcache_lock = threading.Lock()
+
+
+def get_memcache_client():
+    """
+    Клиент pymemcache для MEMCACHE_SERVERS (host:port, несколько серверов - HashClient),
+    создается заново в каждом процессе. None, если memcache не настроен
+    """
+    servers = Config().get_as_list('MEMCACHE_SERVERS')
+    if not servers:
+        return None
+    pid = os.getpid()
+    with _memcache_lock:
+        client = _memcache_clients.get(pid)
+        if client is None:
+            _memcache_clients.clear()
+            timeout = Config().get_as_int('MEMCACHE_TIMEOUT_MS', 100) / 1000.0
+            servers = [_parse_server(i) for i in servers]
+            if len(servers) == 1:
+                client = MemcacheClient(servers[0], connect_timeout=timeout, timeout=timeout)
+            else:
+                client = HashClient(servers, connect_timeout=timeout, timeout=timeout)
+            _memcache_clients[pid] = client
+        return client
+
+
+class MemcacheCache(object):
+    """
+    Кеш в memcache с интерфейсом LRUCache (ключи - строки).
+    Ошибки memcache не пробрасываются, а считаются промахом
+    """
+
+    def __init__(self, client_factory=get_memcache_client, prefix='', ttl=None, dumps=pickle.dumps,
+                 loads=pickle.loads):
+        self.client_factory = client_factory
+        self.prefix = prefix
+        self.ttl = ttl
+        self.dumps = dumps
+        self.loads = loads
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def make_key(self, key):
+        key = self.prefix + key
+        if len(key) > 200 or any(i.isspace() for i in key):
+            key = self.prefix + hashlib.md5(key.encode('utf-8')).hexdigest()
+        return key
+
+    def get_many(self, keys):
+        client = self.client_factory()
+        if client is None or not keys:
+            return {}
+        mapping = {self.make_key(i): i for i in keys}
+        try:
+            values = client.get_many(list(mapping))
+        except Exception as e:
+            self.errors += 1
+            logger.warning('Memcache get failed: %s', e)
+            values = {}
+        result = {mapping[key]: self.loads(value) for key, value in values.items()}
+        self.hits += len(result)
+        self.misses += len(keys) - len(result)
+        return result
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set_many(self, mapping, ttl=None):
+        client = self.client_factory()
+        if client is None or not mapping:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        try:
+            client.set_many({self.make_key(key): self.dumps(value) for key, value in mapping.items()},
+                            expire=int(ttl or 0))
+        except Exception as e:
+            self.errors += 1
+            logger.warning('Memcache set failed: %s', e)
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def delete_many(self, keys):
+        client = self.client_factory()
+        if client is None or not keys:
+            return
+        try:
+            client.delete_many([self.make_key(i) for i in keys])
+        except Exception as e:
+            self.errors += 1
+            logger.warning('Memcache delete failed: %s', e)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'errors': self.errors}
+
+
+class TieredCache(object):
+    """
+    Двухуровневый кеш: LRU внутри воркера (с коротким local_ttl) перед общим кешем (например MemcacheCache)
+    """
+
+    def __init__(self, local, remote=None, local_ttl=None):
+        self.local = local
+        self.remote = remote
+        self.local_ttl = local_ttl
+
+    def _local_ttl(self, ttl):
+        if self.local_ttl is None:
+            return ttl
+        return min(ttl, self.local_ttl) if ttl else self.local_ttl
+
+    def get_many(self, keys):
+        result = self.local.get_many(keys)
+        missing = [i for i in keys if i not in result]
+        if missing and self.remote is not None:
+            found = self.remote.get_many(missing)
+            if found:
+                self.local.set_many(found, self.local_ttl)
+                result.update(found)
+        return result
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set_many(self, mapping, ttl=None):
+        self.local.set_many(mapping, self._local_ttl(ttl))
+        if self.remote is not None:
+            self.remote.set_many(mapping, ttl)
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def delete_many(self, keys):
+        self.local.delete_many(keys)
+        if self.remote is not None:
+            self.remote.delete_many(keys)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def stats(self):
+        return {
+            'local': self.local.stats(),
+            'remote': self.remote.stats() if self.remote is not None else None,
+        }
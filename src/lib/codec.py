@@ -0,0 +1,80 @@
+import json
+import zlib
+
+import bson
+import six
+
+DEFLATE = 'deflate'
+
+
+class JSONCodec(object):
+    """
+    JSON через dumper (json или bson.json_util), используется и для сообщений без content_type
+    """
+    content_type = 'application/json'
+
+    def __init__(self, dumper=None):
+        self.dumper = dumper or json
+
+    def dumps(self, obj):
+        return self.dumper.dumps(obj)
+
+    def loads(self, body):
+        if isinstance(body, six.binary_type):
+            body = body.decode('utf-8')
+        return self.dumper.loads(body)
+
+
+class BSONCodec(object):
+    """
+    Бинарный BSON с ObjectId, datetime и т.д. без преобразований, значение оборачивается в документ {'r': ...}
+    """
+    content_type = 'application/bson'
+
+    def dumps(self, obj):
+        return bson.BSON.encode({'r': obj})
+
+    def loads(self, body):
+        return bson.BSON(body).decode()['r']
+
+
+class MessageCodec(object):
+    """
+    Кодирует тела сообщений выбранным кодеком (сжимая zlib тела длиннее compress_threshold байт),
+    а входящие декодирует по их content_type и content_encoding
+    """
+
+    def __init__(self, codec=None, dumper=None, compress_threshold=None):
+        legacy = JSONCodec(dumper)
+        self.codec = codec or legacy
+        self.legacy = legacy
+        self.compress_threshold = compress_threshold
+        self.codecs = {
+            JSONCodec.content_type: legacy,
+            BSONCodec.content_type: BSONCodec(),
+        }
+        self.codecs[self.codec.content_type] = self.codec
+
+    def encode(self, obj, codec=None, compress=True):
+        """
+        (тело, свойства amqp.Message)
+        """
+        codec = codec or self.codec
+        body = codec.dumps(obj)
+        properties = {'content_type': codec.content_type}
+        if compress and self.compress_threshold is not None and len(body) > self.compress_threshold:
+            if isinstance(body, six.text_type):
+                body = body.encode('utf-8')
+            body = zlib.compress(body)
+            properties['content_encoding'] = DEFLATE
+        return body, properties
+
+    def decode(self, message):
+        """
+        (значение, кодек сообщения)
+        """
+        codec = self.codecs.get(message.properties.get('content_type'), self.legacy)
+        body = message.body
+        if message.properties.get('content_encoding') == DEFLATE:
+            body = zlib.decompress(body)
+        return codec.loads(body), codec
@@ -1,32 +1,327 @@
-import flatdict
+import base64
+import datetime
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+
 import pymongo
 import six
-from bson import DBRef
+from bson import BSON, DBRef, ObjectId
+from bson.decimal128 import Decimal128
+from pymongo import monitoring
 
+from lib.cache import LRUCache, MemcacheCache, TieredCache
+from lib.config import Config
+from lib.error import InvalidCursorError
 from lib.main import MetaSingleton
-from lib.utils import get_from_dict
+from lib.utils import compile_key_paths, get_from_dict
+
+
+class PoolStatsListener(monitoring.CommandListener):
+    """
+    Статистика использования пула: команды в работе (занятые сокеты) и,
+    если pymongo поддерживает ConnectionPoolListener (3.9+), время ожидания сокета из пула (иначе None)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.commands = 0
+        self.failures = 0
+        self.checkouts = 0
+        self.checkout_failed = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def started(self, event):
+        with self._lock:
+            self.in_flight += 1
+            self.commands += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def succeeded(self, event):
+        with self._lock:
+            self.in_flight -= 1
+
+    def failed(self, event):
+        with self._lock:
+            self.in_flight -= 1
+            self.failures += 1
+
+    def checkout_started(self):
+        self._local.started = time.time()
+
+    def checkout_finished(self, ok):
+        started = getattr(self._local, 'started', None)
+        if started is None:
+            return
+        self._local.started = None
+        wait = time.time() - started
+        with self._lock:
+            if ok:
+                self.checkouts += 1
+            else:
+                self.checkout_failed += 1
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+
+    def stats(self, max_pool_size):
+        wait_tracked = CheckoutWaitListener is not None
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'utilization': float(self.in_flight) / max_pool_size if max_pool_size else None,
+                'commands': self.commands,
+                'failed': self.failures,
+                'checkouts': self.checkouts,
+                'checkout_failed': self.checkout_failed,
+                'avg_wait_time': (self.wait_time / self.checkouts if self.checkouts else 0.0) if wait_tracked else None,
+                'max_wait_time': self.max_wait_time if wait_tracked else None,
+            }
+
+
+if hasattr(monitoring, 'ConnectionPoolListener'):
+    class CheckoutWaitListener(monitoring.ConnectionPoolListener):
+        def __init__(self, stats):
+            self.stats = stats
+
+        def connection_check_out_started(self, event):
+            self.stats.checkout_started()
+
+        def connection_checked_out(self, event):
+            self.stats.checkout_finished(True)
+
+        def connection_check_out_failed(self, event):
+            self.stats.checkout_finished(False)
+
+        def pool_created(self, event):
+            pass
+
+        def pool_ready(self, event):
+            pass
+
+        def pool_cleared(self, event):
+            pass
+
+        def pool_closed(self, event):
+            pass
+
+        def connection_created(self, event):
+            pass
+
+        def connection_ready(self, event):
+            pass
+
+        def connection_closed(self, event):
+            pass
+
+        def connection_checked_in(self, event):
+            pass
+else:
+    CheckoutWaitListener = None
 
 
 @six.add_metaclass(MetaSingleton)
 class Database(object):
+    """
+    Клиенты MongoDB по read preference, настраиваются из Config:
+    MONGO_URI (или MONGO_URIS - словарь имя read preference, например SecondaryPreferred, -> uri),
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_WAIT_QUEUE_TIMEOUT_MS, MONGO_CONNECT_TIMEOUT_MS,
+    MONGO_SOCKET_TIMEOUT_MS, MONGO_SERVER_SELECTION_TIMEOUT_MS.
+    Клиенты не переживают fork: после fork (хук post_fork из lib.process.StandaloneApplication) пул создается заново
+    """
 
     def __init__(self):
         self.connection_pool = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self.pool_stats = PoolStatsListener()
+
+    def client_options(self):
+        config = Config()
+        options = {
+            'maxPoolSize': config.get_as_int('MONGO_MAX_POOL_SIZE', 100),
+            'minPoolSize': config.get_as_int('MONGO_MIN_POOL_SIZE'),
+            'waitQueueTimeoutMS': config.get_as_int('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+            'connectTimeoutMS': config.get_as_int('MONGO_CONNECT_TIMEOUT_MS'),
+            'socketTimeoutMS': config.get_as_int('MONGO_SOCKET_TIMEOUT_MS'),
+            'serverSelectionTimeoutMS': config.get_as_int('MONGO_SERVER_SELECTION_TIMEOUT_MS'),
+        }
+        return {key: value for key, value in options.items() if value is not None}
+
+    def get_uri(self, read_preference):
+        config = Config()
+        uris = config.get_as_dict('MONGO_URIS', {})
+        return uris.get(read_preference.name) or config.get('MONGO_URI', 'mongodb://127.0.0.1')
+
+    def pool_key(self, read_preference):
+        # объекты read preference не хешируются (есть __eq__ без __hash__)
+        return read_preference.name, repr(read_preference.document)
 
     def get_client(self, read_preference):
-        if self.connection_pool.get(read_preference) is None:
-            self.connection_pool[read_preference] = pymongo.MongoClient('mongodb://127.0.0.1',
-                                                                        read_preference=read_preference)
-        return self.connection_pool[read_preference]
+        if self._pid != os.getpid():
+            self.reset()
+        key = self.pool_key(read_preference)
+        client = self.connection_pool.get(key)
+        if client is None:
+            with self._lock:
+                client = self.connection_pool.get(key)
+                if client is None:
+                    listeners = [self.pool_stats]
+                    if CheckoutWaitListener is not None:
+                        listeners.append(CheckoutWaitListener(self.pool_stats))
+                    client = pymongo.MongoClient(
+                        self.get_uri(read_preference), read_preference=read_preference, connect=False,
+                        event_listeners=listeners, **self.client_options()
+                    )
+                    self.connection_pool[key] = client
+        return client
+
+    def reset(self):
+        """
+        Забывает клиентов, унаследованных от родительского процесса (их сокеты закрывать нельзя)
+        """
+        with self._lock:
+            self.connection_pool = {}
+            self._pid = os.getpid()
+            self.pool_stats = PoolStatsListener()
+
+    def close(self):
+        with self._lock:
+            for client in self.connection_pool.values():
+                client.close()
+            self.connection_pool = {}
+
+    def stats(self):
+        return self.pool_stats.stats(self.client_options().get('maxPoolSize'))
 
     def get_database(self, name, read_primary, *args, **kwargs):
-        return pymongo.MongoClient.MongoDatabase(self.get_client(read_primary), name, *args, **kwargs)
+        return pymongo.database.Database(self.get_client(read_primary), name, *args, **kwargs)
 
     def get_collection(self, db_name, name, read_primary, *args, **kwargs):
-        return pymongo.MongoClient.MongoCollection(self.get_database(db_name, read_primary), name, *args, **kwargs)
+        return pymongo.collection.Collection(self.get_database(db_name, read_primary), name, *args, **kwargs)
+
+
+@six.add_metaclass(MetaSingleton)
+class DenormRegistry(object):
+    """
+    Кеш регистраций sys.denorm внутри воркера: ключи extra по коллекциям (пустое множество - нет callback'ов)
+    и LRU пачек callback'ов по ref_id. Записи хранятся вместе с поколением коллекции, которое
+    DenormDBManager.create меняет в любом процессе (в memcache, если задан MEMCACHE_SERVERS, иначе в
+    sys.denorm_generation), записи другого поколения считаются отсутствующими.
+    Поколения перечитываются не чаще раза в DENORM_GENERATION_INTERVAL секунд (без memcache - все одним запросом),
+    это задержка, с которой воркер замечает регистрацию из другого процесса. 0 - читать при каждой записи
+    """
+
+    def __init__(self):
+        config = Config()
+        ttl = config.get_as_int('DENORM_CACHE_TTL', 60)
+        self.collections = LRUCache(config.get_as_int('DENORM_CACHE_COLLECTIONS', 1024), ttl)
+        self.packs = LRUCache(config.get_as_int('DENORM_CACHE_SIZE', 10000), ttl)
+        # уже записанные этим воркером пары (ref_id, callback), см. DenormDBManager.create
+        self.registered = LRUCache(config.get_as_int('DENORM_CACHE_SIZE', 10000), ttl)
+        self.remote_generations = None
+        if config.get_as_list('MEMCACHE_SERVERS'):
+            self.remote_generations = MemcacheCache(prefix='denormgen:')
+        self.generation_interval = float(config.get('DENORM_GENERATION_INTERVAL', 1))
+        self.local_generations = LRUCache(config.get_as_int('DENORM_CACHE_COLLECTIONS', 1024))
+
+    @property
+    def generations(self):
+        return Database().get_collection('sys', 'denorm_generation', pymongo.ReadPreference.PRIMARY)
+
+    def _remember(self, mapping):
+        if self.generation_interval > 0:
+            self.local_generations.set_many(mapping, self.generation_interval)
+
+    def generation(self, db_name, collection_name):
+        name = db_name + '.' + collection_name
+        value = self.local_generations.get(name)
+        if value is not None:
+            return value
+        if self.remote_generations is None:
+            # документов немного - по одному на коллекцию с зависимыми, читаются все сразу
+            found = {i['_id']: i['g'] for i in self.generations.find({})}
+            value = found.setdefault(name, 0)
+        else:
+            value = self.remote_generations.get(name)
+            if value is None:
+                # поколение вытеснено или memcache недоступен - кешированным записям верить нельзя
+                value = uuid.uuid4().hex
+                self.remote_generations.set(name, value)
+            found = {name: value}
+        self._remember(found)
+        return value
+
+    def invalidate(self, db_name, collection_name, id_list):
+        name = db_name + '.' + collection_name
+        if self.remote_generations is None:
+            doc = self.generations.find_one_and_update(
+                {'_id': name}, {'$inc': {'g': 1}}, upsert=True, return_document=pymongo.ReturnDocument.AFTER
+            )
+            value = doc['g']
+        else:
+            value = uuid.uuid4().hex
+            self.remote_generations.set(name, value)
+        self._remember({name: value})
+        self.collections.delete((db_name, collection_name))
+        self.packs.delete_many([(db_name, collection_name, _id) for _id in id_list])
+
+    def stats(self):
+        return {'collections': self.collections.stats(), 'packs': self.packs.stats()}
+
+
+# вызываются после каждой записи через DBManager с (db_name, collection_name), см. lib.httpcache
+write_hooks = []
+
+
+@six.add_metaclass(MetaSingleton)
+class DocumentCache(object):
+    """
+    Кеш документов для DBManager.get_by_id и find_by_id_list по (db, collection, _id).
+    Включается для коллекций из DOCUMENT_CACHE (словарь 'db.collection' -> ttl в секундах),
+    LRU воркера (DOCUMENT_CACHE_SIZE, не дольше DOCUMENT_CACHE_LOCAL_TTL) перед memcache (MEMCACHE_SERVERS)
+    """
+
+    def __init__(self):
+        config = Config()
+        self.ttls = {key: int(value) for key, value in config.get_as_dict('DOCUMENT_CACHE', {}).items()}
+        remote = None
+        if config.get_as_list('MEMCACHE_SERVERS'):
+            remote = MemcacheCache(prefix='doc:', dumps=bytes, loads=bytes)
+        self.cache = TieredCache(
+            LRUCache(config.get_as_int('DOCUMENT_CACHE_SIZE', 10000)), remote,
+            local_ttl=config.get_as_int('DOCUMENT_CACHE_LOCAL_TTL', 5)
+        )
+
+    def get_ttl(self, db_name, collection_name):
+        return self.ttls.get(db_name + '.' + collection_name)
+
+    def key(self, db_name, collection_name, _id):
+        return '{}.{}:{}:{}'.format(db_name, collection_name, type(_id).__name__, _id)
+
+    def get_many(self, db_name, collection_name, id_list):
+        keys = {self.key(db_name, collection_name, _id): _id for _id in id_list}
+        # документы хранятся в BSON, чтобы изменения у вызывающего не попадали в кеш
+        return {keys[key]: BSON(value).decode() for key, value in self.cache.get_many(list(keys)).items()}
+
+    def set_many(self, db_name, collection_name, docs, ttl):
+        self.cache.set_many({self.key(db_name, collection_name, doc['_id']): BSON.encode(doc) for doc in docs}, ttl)
+
+    def delete_many(self, db_name, collection_name, id_list):
+        self.cache.delete_many([self.key(db_name, collection_name, _id) for _id in id_list])
+
+    def stats(self):
+        return self.cache.stats()
 
 
 class DBManager(object):
+    denorm_batch_size = 1000
 
     def __init__(self, db_name, collection, read_preference=pymongo.read_preferences.ReadPreference.SECONDARY_PREFERRED):
         self.read_preference = read_preference
@@ -34,6 +329,10 @@ class DBManager(object):
         self.db_name = db_name
         self._db = None
 
+    @property
+    def collection_name(self):
+        return self.collection
+
     @property
     def db(self):
 
@@ -47,59 +346,156 @@ class DBManager(object):
     def create_indexes(self):
         raise NotImplementedError()
 
+    @property
+    def cache_ttl(self):
+        return DocumentCache().get_ttl(self.db_name, self.collection)
+
+    @property
+    def primary_db(self):
+        """
+        Коллекция с чтением из primary: кеш заполняется только отсюда, иначе отстающая реплика
+        вернет в кеш документ, каким он был до только что инвалидированной записи
+        """
+        return self.db.with_options(read_preference=pymongo.ReadPreference.PRIMARY)
+
     def find_by_id_list(self, id_list):
-        return self.db.find({'_id': {'$in': id_list}})
+        """
+        Список найденных документов, отсутствующие _id пропускаются
+        """
+        ttl = self.cache_ttl
+        if not ttl:
+            return list(self.db.find({'_id': {'$in': id_list}}))
+        cache = DocumentCache()
+        docs = cache.get_many(self.db_name, self.collection, id_list)
+        missing = [_id for _id in id_list if _id not in docs]
+        if missing:
+            loaded = list(self.primary_db.find({'_id': {'$in': missing}}))
+            cache.set_many(self.db_name, self.collection, loaded, ttl)
+            docs.update((i['_id'], i) for i in loaded)
+        return [docs[_id] for _id in id_list if _id in docs]
 
     def get_by_id(self, _id):
-        return self.db.find_one({'_id': _id})
+        ttl = self.cache_ttl
+        if not ttl:
+            return self.db.find_one({'_id': _id})
+        cache = DocumentCache()
+        doc = cache.get_many(self.db_name, self.collection, [_id]).get(_id)
+        if doc is None:
+            doc = self.primary_db.find_one({'_id': _id})
+            if doc is not None:
+                cache.set_many(self.db_name, self.collection, [doc], ttl)
+        return doc
+
+    def get_cached_ids(self, query):
+        """
+        _id документов по запросу, если для коллекции включен кеш (для последующей инвалидации)
+        """
+        if not self.cache_ttl:
+            return []
+        return [i['_id'] for i in self.primary_db.find(query, {'_id': 1})]
+
+    def invalidate_cache(self, id_list):
+        if id_list and self.cache_ttl:
+            DocumentCache().delete_many(self.db_name, self.collection, id_list)
+        for hook in write_hooks:
+            hook(self.db_name, self.collection)
+
+    def _ids_for_key(self, _item_one_or_list, key):
+        if key == '_id':
+            return _item_one_or_list if isinstance(_item_one_or_list, list) else [_item_one_or_list]
+        if isinstance(_item_one_or_list, list):
+            return self.get_cached_ids({key: {'$in': _item_one_or_list}})
+        return self.get_cached_ids({key: _item_one_or_list})
 
     def delete_one_or_many(self, _item_one_or_list, key='_id'):
+        id_list = self._ids_for_key(_item_one_or_list, key)
         if isinstance(_item_one_or_list, list):
-            return self.db.delete_many({key: {'$in':_item_one_or_list}})
+            result = self.db.delete_many({key: {'$in':_item_one_or_list}})
         else:
-            return self.db.delete_one({key: _item_one_or_list})
+            result = self.db.delete_one({key: _item_one_or_list})
+        self.invalidate_cache(id_list)
+        return result
 
     def cursor_map(self, cursor):
         return {str(i['_id']): i for i in list(cursor)}
 
+    def denorm_snapshot(self, query, projection):
+        primary = self.db.with_options(read_preference=pymongo.ReadPreference.PRIMARY)
+        return {i['_id']: i for i in primary.find(query, projection, batch_size=self.denorm_batch_size)}
+
+    def iter_denorm_changes(self, old_map, projection, extra_ids=()):
+        """
+        Перечитывает документы из old_map по _id пачками и отдает списки изменений (_id, old, new),
+        old_map освобождается по мере чтения
+        """
+        primary = self.db.with_options(read_preference=pymongo.ReadPreference.PRIMARY)
+        id_list = list(old_map) + list(extra_ids)
+        for i in range(0, len(id_list), self.denorm_batch_size):
+            cursor = primary.find({'_id': {'$in': id_list[i:i + self.denorm_batch_size]}}, projection)
+            yield [(doc['_id'], old_map.pop(doc['_id'], None), doc) for doc in cursor]
+
     def update_many_denormalized(self, query, data, *args, **kwargs):
-        old_cursor_map = self.cursor_map(self.db.find(query))
-        result = self.collection.update_many(query, data, *args, **kwargs)
-        if result.modified_count > 0:
-            new_cursor = self.db.find(query)
-            if new_cursor.count() > 0:
-                new_cursor_map = self.cursor_map(new_cursor)
-                denorm_db = DenormDBManager()
-                denorm_db.denorm_collection(self.db, old_cursor_map, new_cursor_map)
+        denorm_db = DenormDBManager()
+        generations = {}
+        projection = denorm_db.get_projection(self.db_name, self.collection, generations)
+        if projection is None:
+            id_list = self.get_cached_ids(query)
+            result = self.db.update_many(query, data, *args, **kwargs)
+            self.invalidate_cache(id_list)
+            return result
+        old_map = self.denorm_snapshot(query, projection)
+        result = self.db.update_many(query, data, *args, **kwargs)
+        self.invalidate_cache(list(old_map))
+        if result.modified_count > 0 or result.upserted_id is not None:
+            upserted = [result.upserted_id] if result.upserted_id is not None else []
+            for changes in self.iter_denorm_changes(old_map, projection, upserted):
+                if changes:
+                    denorm_db.dispatch(self.db_name, self.collection, changes, generations)
         return result
 
     def update_one_denormalized(self, query, data, *args, **kwargs):
-        doc_before = self.db.find_one(query)
-        doc_after = self.collection.find_one_and_update(
+        denorm_db = DenormDBManager()
+        generations = {}
+        projection = denorm_db.get_projection(self.db_name, self.collection, generations)
+        doc_before = None
+        if projection is not None:
+            primary = self.db.with_options(read_preference=pymongo.ReadPreference.PRIMARY)
+            doc_before = primary.find_one(query, projection)
+        doc_after = self.db.find_one_and_update(
             query, data, return_document=pymongo.ReturnDocument.AFTER, *args, **kwargs
         )
         if doc_after:
-            denorm_db = DenormDBManager()
-            denorm_db.denorm(self.db, doc_after['_id'], doc_before, doc_after)
+            self.invalidate_cache([doc_after['_id']])
+        if doc_after and projection is not None:
+            denorm_db.denorm(self, doc_after['_id'], doc_before, doc_after, generations)
 
     def update_one_or_many(self, _item_one_or_list, key='_id', update=None):
         if update is None:
             raise ValueError('update must be not empty')
+        id_list = self._ids_for_key(_item_one_or_list, key)
         if isinstance(_item_one_or_list, list):
-            return self.db.update_many({key: {'$in': _item_one_or_list}}, update)
+            result = self.db.update_many({key: {'$in': _item_one_or_list}}, update)
         else:
-            return self.db.update_one({key: _item_one_or_list}, update)
+            result = self.db.update_one({key: _item_one_or_list}, update)
+        self.invalidate_cache(id_list)
+        return result
 
     def _create(self, parameters):
         parameters['_id'] = self.db.insert_one(parameters).inserted_id
+        self.invalidate_cache([])
         return parameters
 
 
 
 class DenormDBManager(DBManager):
+    max_depth = 8
+    create_batch_size = 1000
+    # если задан (см. lib.denorm.DenormPublisher) - каскад выполняется асинхронно воркером
+    publisher = None
 
     def __init__(self):
-        super(DenormDBManager, self).__init__('sys', 'denorm')
+        # регистрации кешируются под текущим поколением, отстающая реплика закрепила бы устаревший ответ
+        super(DenormDBManager, self).__init__('sys', 'denorm', read_preference=pymongo.ReadPreference.PRIMARY)
 
     def create_indexes(self):
         self.collection.create_index([
@@ -109,92 +505,228 @@ class DenormDBManager(DBManager):
         ], background=True, name='denorm')
 
     def create(self, loader, callback):
-        if loader.extra is not None:
-            for _id in loader._id_list if hasattr(loader, '_id_list') else [loader._id]:
-                data = {
-                    '$set': {
-                        'db_name': loader.db_name,
-                        'collection_name': loader.collection_name,
-                        'ref_id': _id
+        if loader.extra is None:
+            return
+        callback_item = {
+            'db_name': callback.db_name,
+            'collection_name': callback.collection_name,
+            'extra': loader.extra,
+            'query_path': callback.query_path,
+            'set_path': callback.set_path,
+            'query': callback.query
+        }
+        registry = DenormRegistry()
+        callback_key = BSON.encode(callback_item)
+        id_list = loader._id_list if hasattr(loader, '_id_list') else [loader._id]
+        keys = [(loader.db_name, loader.collection_name, _id, callback_key) for _id in id_list]
+        registered = registry.registered.get_many(keys)
+        id_list = [key[2] for key in keys if key not in registered]
+        if not id_list:
+            return
+        changed = 0
+        for i in range(0, len(id_list), self.create_batch_size):
+            requests = [
+                pymongo.UpdateOne(
+                    {'db_name': loader.db_name, 'collection_name': loader.collection_name, 'ref_id': _id},
+                    {
+                        '$set': {
+                            'db_name': loader.db_name,
+                            'collection_name': loader.collection_name,
+                            'ref_id': _id
+                        },
+                        '$addToSet': {'callback': callback_item}
                     },
-                    '$addToSet': {
-                        'callback': {
-                            'db_name': callback.db_name,
-                            'collection_name': callback.collection_name,
-                            'extra': loader.extra,
-                            'query_path': callback.query_path,
-                            'set_path': callback.set_path,
-                            'query': callback.query
-                        }
-                    }
-                }
-                self.db.update_one({
-                    'db_name': loader.db_name,
-                    'collection_name': loader.collection_name,
-                    'ref_id': _id}, data, upsert=True)
-
-    def denorm_collection(self, db, old_map, new_map):
-        for key, value in new_map.items():
-            self.denorm(db, value['_id'], old_map[key], value)
-
-    def denorm(self, db, _id, old, new):
-        denorm_pack = self.db.find_one({'db_name': db.db_name, 'collection_name': db.collection_name, 'ref_id': _id})
-        if denorm_pack is None:
+                    upsert=True
+                ) for _id in id_list[i:i + self.create_batch_size]
+            ]
+            result = self.db.bulk_write(requests, ordered=False)
+            changed += result.upserted_count + result.modified_count
+        registry.registered.set_many({key: True for key in keys})
+        # пары уже были в sys.denorm (например, после истечения registered) - кеши других воркеров верны
+        if changed:
+            registry.invalidate(loader.db_name, loader.collection_name, id_list)
+
+    def denorm_collection(self, db, old_map, new_map, generations=None):
+        changes = [(value['_id'], old_map.get(key), value) for key, value in new_map.items()]
+        self.dispatch(db.db_name, db.collection_name, changes, generations)
+
+    def denorm(self, db, _id, old, new, generations=None):
+        self.dispatch(db.db_name, db.collection_name, [(_id, old, new)], generations)
+
+    def generation(self, db_name, collection_name, generations=None):
+        """
+        Поколение коллекции, generations - словарь на время одной записи, чтобы каскад не перечитывал поколения
+        """
+        if generations is None:
+            return DenormRegistry().generation(db_name, collection_name)
+        key = (db_name, collection_name)
+        if key not in generations:
+            generations[key] = DenormRegistry().generation(db_name, collection_name)
+        return generations[key]
+
+    def dispatch(self, db_name, collection_name, changes, generations=None):
+        if generations is None:
+            generations = {}
+        if self.publisher is None:
+            return self.propagate(db_name, collection_name, changes, generations)
+        keys = self.get_collection_keys(
+            db_name, collection_name, self.generation(db_name, collection_name, generations)
+        )
+        if not keys:
             return
-        denorm_items = [i for i in denorm_pack.get('callback', []) if
-                        (i.get('extra') is not None and i.get('db_name') is not None)]
-        keys_for_check = self.get_keys_for_check(denorm_items)
-        updated_keys = self.get_updated_keys(old, new, keys_for_check)
-        for denorm_item in denorm_items:
-            extra_keys = denorm_item.get('extra')
-            if not self.any_in_array(extra_keys, updated_keys):
+        events = []
+        for _id, old, new in changes:
+            old = self.prepare_extra(old or {}, keys)
+            new = self.prepare_extra(new, keys)
+            if old != new:
+                events.append((_id, old, new))
+        if events:
+            self.publisher.publish(db_name, collection_name, events)
+
+    def propagate(self, db_name, collection_name, changes, generations=None):
+        """
+        Распространяет изменения документов по всем зарегистрированным callback'ам.
+        Изменения обрабатываются уровнями: все обновления одного уровня группируются
+        по (db, collection) и отправляются одним unordered bulk_write,
+        следующий уровень читается только если у коллекции есть свои callback'и.
+
+        :param changes: список (_id, old, new)
+        :param generations: поколения коллекций, уже прочитанные в этой записи (см. generation)
+        """
+        if generations is None:
+            generations = {}
+        level = {(db_name, collection_name): changes}
+        depth = 0
+        while level and depth < self.max_depth:
+            writes = defaultdict(OrderedDict)
+            for (source_db, source_collection), source_changes in level.items():
+                self.collect_writes(source_db, source_collection, source_changes, writes, generations)
+            level = {}
+            for target, updates in writes.items():
+                target_changes = self.apply_writes(target, updates, generations)
+                if target_changes:
+                    level[target] = target_changes
+            depth += 1
+
+    def get_denorm_packs(self, db_name, collection_name, id_list, generation=None):
+        registry = DenormRegistry()
+        if generation is None:
+            generation = registry.generation(db_name, collection_name)
+        if not self.get_collection_keys(db_name, collection_name, generation):
+            return {}
+        cached = registry.packs.get_many([(db_name, collection_name, _id) for _id in id_list])
+        cached = {key[2]: pack for key, (pack_generation, pack) in cached.items() if pack_generation == generation}
+        packs = {_id: pack for _id, pack in cached.items() if pack is not None}
+        missing = [_id for _id in id_list if _id not in cached]
+        if missing:
+            cursor = self.db.find({'db_name': db_name, 'collection_name': collection_name, 'ref_id': {'$in': missing}})
+            loaded = {i['ref_id']: i for i in cursor}
+            registry.packs.set_many({(db_name, collection_name, _id): (generation, loaded.get(_id)) for _id in missing})
+            packs.update(loaded)
+        return packs
+
+    def get_collection_keys(self, db_name, collection_name, generation=None):
+        registry = DenormRegistry()
+        if generation is None:
+            generation = registry.generation(db_name, collection_name)
+        cached = registry.collections.get((db_name, collection_name))
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        keys = set()
+        for extra in self.db.distinct('callback.extra', {'db_name': db_name, 'collection_name': collection_name}):
+            if isinstance(extra, list):
+                keys.update(extra)
+            else:
+                keys.add(extra)
+        keys = frozenset(keys)
+        registry.collections.set((db_name, collection_name), (generation, keys))
+        return keys
+
+    def get_projection(self, db_name, collection_name, generations=None):
+        generation = self.generation(db_name, collection_name, generations)
+        keys = self.get_collection_keys(db_name, collection_name, generation)
+        if not keys:
+            return None
+        return make_projection(keys)
+
+    def collect_writes(self, db_name, collection_name, changes, writes, generations=None):
+        denorm_packs = self.get_denorm_packs(
+            db_name, collection_name, [i[0] for i in changes], self.generation(db_name, collection_name, generations)
+        )
+        for _id, old, new in changes:
+            denorm_pack = denorm_packs.get(_id)
+            if denorm_pack is None:
                 continue
-            item = new
-            extra = self.prepare_extra(item, denorm_item.get('extra'))
-            item = DBRef(
-                db.collection_name, _id, db.db_name, _extra=extra
-            )
-            ref_db = DBManager(
-                db_name=denorm_item.get('db_name'),
-                collection=denorm_item.get('collection_name'),
-            )
-            query = {denorm_item.get('query_path', '') + '.$id': _id}
-            if denorm_item.get('query'):
-                query.update(denorm_item.get('query'))
-            ref_db.update_many_denormalized(
-                query,
-                {'$set': {denorm_item.get('set_path'): item}}
-            )
+            denorm_items = [i for i in denorm_pack.get('callback', []) if
+                            (i.get('extra') is not None and i.get('db_name') is not None)]
+            keys_for_check = self.get_keys_for_check(denorm_items)
+            updated_keys = self.get_updated_keys(old or {}, new, keys_for_check)
+            if not updated_keys:
+                continue
+            for denorm_item in denorm_items:
+                if not self.any_in_array(denorm_item.get('extra'), updated_keys):
+                    continue
+                extra = self.prepare_extra(new, denorm_item.get('extra'))
+                item = DBRef(collection_name, _id, db_name, _extra=extra)
+                query = {denorm_item.get('query_path', '') + '.$id': _id}
+                if denorm_item.get('query'):
+                    query.update(denorm_item.get('query'))
+                target = (denorm_item.get('db_name'), denorm_item.get('collection_name'))
+                # одинаковые запросы объединяются в один $set, повторный путь перезаписывается
+                _, update = writes[target].setdefault(BSON.encode(query), (query, {}))
+                update[denorm_item.get('set_path')] = item
+
+    def apply_writes(self, target, updates, generations=None):
+        db_name, collection_name = target
+        ref_db = DBManager(db_name, collection_name, read_preference=pymongo.ReadPreference.PRIMARY)
+        projection = self.get_projection(db_name, collection_name, generations)
+        snapshot_query = {'$or': [query for query, _ in updates.values()]}
+        if projection is not None:
+            old_map = ref_db.denorm_snapshot(snapshot_query, projection)
+            id_list = list(old_map)
+        else:
+            id_list = ref_db.get_cached_ids(snapshot_query)
+        ref_db.db.bulk_write(
+            [pymongo.UpdateMany(query, {'$set': update}) for query, update in updates.values()], ordered=False
+        )
+        ref_db.invalidate_cache(id_list)
+        if projection is None:
+            return []
+        return [change for changes in ref_db.iter_denorm_changes(old_map, projection) for change in changes]
 
     def get_keys_for_check(self, items):
         return set([keypath for item in items for keypath in item.get('extra')])
 
     def get_updated_keys(self, old, new, keys_for_check):
-        updated_keys = []
-        for key in keys_for_check:
-            if get_from_dict(old, key) != get_from_dict(new, key):
-                updated_keys.append(key)
-        return updated_keys
+        return [path.path for path in compile_key_paths(keys_for_check).paths if path.get(old) != path.get(new)]
 
     def any_in_array(self, array1, array2):
         return len(set(array2).intersection(set(array1))) > 0
 
     def prepare_extra(self, item, fields):
-        extra = flatdict.FlatDict({}, delimiter='.')
-        item = flatdict.FlatDict(item, delimiter='.')
-        for key in fields:
-            extra[key] = item.get(key)
-        extra = extra.as_dict()
-        return extra
+        return compile_key_paths(fields).extract(item)
 
 
 
 
-def cursor_to_result(cursor, skip=None, limit=None):
-    """
+def make_projection(keys):
+    projection = {}
+    for key in sorted(keys):
+        # вложенный путь уже покрыт родительским, иначе mongo вернет path collision
+        if not any(key.startswith(i + '.') for i in projection):
+            projection[key] = 1
+    return projection
 
-    :type cursor: pymongo.Cursor
-    """
+
+TOTAL_EXACT = 'exact'
+TOTAL_ESTIMATED = 'estimated'
+TOTAL_CACHED = 'cached'
+TOTAL_NONE = 'none'
+
+_count_cache = LRUCache(1024)
+
+
+def _parse_pagination(skip, limit):
     try:
         if limit is not None:
             limit = int(limit)
@@ -203,14 +735,118 @@ def cursor_to_result(cursor, skip=None, limit=None):
     except (ValueError, TypeError):
         limit = None
         skip = None
-    total = cursor.count()
+    return skip, limit
+
+
+def count_query(collection, query, total=TOTAL_EXACT):
+    """
+    exact - точное количество, estimated - размер всей коллекции по метаданным (без учета query),
+    cached - точное количество, закешированное на COUNT_CACHE_TTL секунд, none - не считать
+    """
+    if total == TOTAL_NONE:
+        return None
+    if total == TOTAL_ESTIMATED:
+        return collection.count()
+    if total == TOTAL_CACHED:
+        key = (collection.full_name, BSON.encode(query))
+        value = _count_cache.get(key)
+        if value is None:
+            value = collection.count(query)
+            _count_cache.set(key, value, Config().get_as_int('COUNT_CACHE_TTL', 60))
+        return value
+    return collection.count(query)
+
+
+def cursor_to_result(cursor, skip=None, limit=None, total=TOTAL_EXACT, lazy=False):
+    """
+    lazy - вернуть в objects сам курсор (для потоковой отдачи, см. lib.parser.use_schema)
+
+    :type cursor: pymongo.Cursor
+    """
+    skip, limit = _parse_pagination(skip, limit)
+    if total == TOTAL_EXACT:
+        total = cursor.count()
+    else:
+        # у pymongo.Cursor нет публичного доступа к фильтру, а он нужен для ключа кеша количества
+        total = count_query(cursor.collection, cursor._Cursor__spec, total)
     if skip is not None:
         cursor.skip(skip)
     if limit is not None:
         cursor.limit(limit)
     return {
-        'objects': list(cursor),
+        'objects': cursor if lazy else list(cursor),
         'total': total
     }
 
 
+# токен приходит от клиента: документ или массив в нем подставился бы в запрос как операторы ($ne, $where...)
+KEYSET_TOKEN_TYPES = six.string_types + six.integer_types + (
+    six.binary_type, float, datetime.datetime, ObjectId, Decimal128, type(None)
+)
+
+
+def encode_keyset_token(value, _id):
+    return base64.urlsafe_b64encode(BSON.encode({'v': value, 'i': _id})).decode('ascii')
+
+
+def decode_keyset_token(token):
+    try:
+        data = BSON(base64.urlsafe_b64decode(str(token))).decode()
+        value, _id = data['v'], data['i']
+    except Exception:
+        raise InvalidCursorError()
+    if not isinstance(value, KEYSET_TOKEN_TYPES) or not isinstance(_id, KEYSET_TOKEN_TYPES):
+        raise InvalidCursorError()
+    return value, _id
+
+
+def _keyset_condition(sort_key, value, _id, direction):
+    """
+    Документы после (value, _id) в порядке сортировки. null и отсутствующий sort_key mongo ставит
+    перед любыми значениями, поэтому по возрастанию они идут первыми, а по убыванию - последними
+    """
+    op = '$gt' if direction == pymongo.ASCENDING else '$lt'
+    same = {sort_key: value, '_id': {op: _id}}
+    if direction == pymongo.ASCENDING:
+        if value is None:
+            return {'$or': [same, {sort_key: {'$ne': None}}]}
+        return {'$or': [{sort_key: {op: value}}, same]}
+    if value is None:
+        return same
+    return {'$or': [{sort_key: {op: value}}, same, {sort_key: None}]}
+
+
+def keyset_to_result(collection, query, after=None, limit=None, sort_key='_id', direction=pymongo.ASCENDING,
+                     projection=None, total=TOTAL_NONE):
+    """
+    Постраничная выдача по ключу сортировки вместо skip: after - токен из поля next предыдущей страницы,
+    сортировка по (sort_key, _id), поэтому стоимость страницы не зависит от ее номера.
+    projection должен включать sort_key
+
+    :type collection: pymongo.collection.Collection
+    """
+    _, limit = _parse_pagination(None, limit)
+    page_query = query
+    if after:
+        value, _id = decode_keyset_token(after)
+        op = '$gt' if direction == pymongo.ASCENDING else '$lt'
+        if sort_key == '_id':
+            condition = {'_id': {op: _id}}
+        else:
+            condition = _keyset_condition(sort_key, value, _id, direction)
+        page_query = {'$and': [query, condition]} if query else condition
+    sort = [('_id', direction)] if sort_key == '_id' else [(sort_key, direction), ('_id', direction)]
+    cursor = collection.find(page_query, projection).sort(sort)
+    if limit is not None:
+        cursor.limit(limit + 1)
+    objects = list(cursor)
+    next_token = None
+    if limit is not None and len(objects) > limit:
+        objects = objects[:limit]
+        last = objects[-1]
+        next_token = encode_keyset_token(get_from_dict(last, sort_key), last['_id'])
+    return {
+        'objects': objects,
+        'total': count_query(collection, query, total),
+        'next': next_token
+    }
@@ -0,0 +1,168 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import pymongo
+
+from lib.amqp import RequeueError
+from lib.db import DBManager, DenormDBManager
+
+logger = logging.getLogger(__name__)
+
+DENORM_EVENT = 'changed'
+
+
+class DenormPublisher(object):
+    """
+    Публикует изменения документов вместо синхронного каскада денормализации.
+    client_factory должен возвращать lib.amqp.Client с кодеком, понимающим bson типы
+    (BSONCodec или dumper=bson.json_util), клиент создается лениво и пересоздается после fork
+    """
+
+    def __init__(self, client_factory):
+        self.client_factory = client_factory
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = self.client_factory()
+                self._pid = os.getpid()
+            return self._client
+
+    def publish(self, db_name, collection_name, changes):
+        self.client.publish(DENORM_EVENT, db_name, collection_name, changes, time.time())
+
+
+def enable_async(client_factory):
+    DenormDBManager.publisher = DenormPublisher(client_factory)
+
+
+def disable_async():
+    DenormDBManager.publisher = None
+
+
+class _Batch(object):
+    """
+    Изменения одного flush: обработчики их сообщений ждут применения, чтобы подтвердить сообщение
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class DenormWorker(object):
+    """
+    Принимает события DenormPublisher через lib.amqp.Server, склеивает повторные изменения одного ref_id
+    за окно window секунд и применяет их пачкой. old берется из первого события, а new перечитывается
+    из primary при применении, поэтому порядок событий между консьюмерами не важен.
+    Сообщение подтверждается только после применения, при ошибке возвращается в очередь.
+    Обработчики ждут flush, поэтому server должен быть threaded с prefetch_count не меньше ожидаемой пачки
+    """
+
+    def __init__(self, server, window=0.5, max_pending=1000, retry_delay=1):
+        self.server = server
+        self.window = window
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.pending = OrderedDict()
+        self.batch = _Batch()
+        self.lock = threading.Lock()
+        self.apply_lock = threading.Lock()
+        self.stats = {
+            'received': 0,
+            'coalesced': 0,
+            'applied': 0,
+            'deleted': 0,
+            'errors': 0,
+            'pending': 0,
+            'lag': 0.0,
+            'max_lag': 0.0,
+        }
+        self._thread = None
+        server.register_endpoint(DENORM_EVENT, self.changed)
+
+    def changed(self, db_name, collection_name, changes, ts):
+        with self.lock:
+            for _id, old, new in changes:
+                key = (db_name, collection_name, _id)
+                self.stats['received'] += 1
+                if key in self.pending:
+                    self.stats['coalesced'] += 1
+                else:
+                    self.pending[key] = (old, ts)
+            self.stats['pending'] = len(self.pending)
+            overflow = len(self.pending) >= self.max_pending
+            batch = self.batch
+        if overflow:
+            self.flush()
+        batch.done.wait()
+        if batch.error is not None:
+            time.sleep(self.retry_delay)
+            raise RequeueError('Denorm flush failed: {}'.format(batch.error))
+
+    def flush(self):
+        with self.apply_lock:
+            with self.lock:
+                pending, self.pending = self.pending, OrderedDict()
+                batch, self.batch = self.batch, _Batch()
+                self.stats['pending'] = 0
+            try:
+                if pending:
+                    self.apply(pending)
+            except Exception as e:
+                batch.error = e
+                self.stats['errors'] += len(pending)
+                logger.error(e)
+            finally:
+                batch.done.set()
+
+    def apply(self, pending):
+        groups = defaultdict(OrderedDict)
+        oldest = None
+        for (db_name, collection_name, _id), (old, ts) in pending.items():
+            groups[(db_name, collection_name)][_id] = old
+            oldest = ts if oldest is None else min(oldest, ts)
+        denorm_db = DenormDBManager()
+        generations = {}
+        for (db_name, collection_name), old_map in groups.items():
+            projection = denorm_db.get_projection(db_name, collection_name, generations)
+            if projection is None:
+                continue
+            source = DBManager(db_name, collection_name, read_preference=pymongo.ReadPreference.PRIMARY)
+            current = dict((i['_id'], i) for i in source.db.find({'_id': {'$in': list(old_map)}}, projection))
+            # удаленные документы не распространяются, как и при синхронной денормализации
+            changes = [(_id, old, current[_id]) for _id, old in old_map.items() if _id in current]
+            self.stats['deleted'] += len(old_map) - len(changes)
+            if changes:
+                denorm_db.propagate(db_name, collection_name, changes, generations)
+            self.stats['applied'] += len(changes)
+        lag = time.time() - oldest
+        self.stats['lag'] = lag
+        self.stats['max_lag'] = max(self.stats['max_lag'], lag)
+        logger.debug('Denorm flush: %s documents, lag %.3fs', len(pending), lag)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.window)
+            self.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._flush_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        self.server.start()
+        self.flush()
+
+    def stop(self):
+        self.server.stop()
@@ -0,0 +1,90 @@
+import json
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.config import Config
+from lib.db import DBManager
+from lib.utils import append_db_ref, iter_db_refs
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(Config().get_as_int('DEREF_POOL_SIZE', 8))
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def projection_key(projection):
+    """
+    Хешируемый ключ projection (словарь или список полей), None - документ целиком
+    """
+    if projection is None:
+        return None
+    return json.dumps(projection, sort_keys=True, default=str)
+
+
+class DerefLoader(object):
+    """
+    Разыменование DBRef в рамках одного запроса (см. ApiRequest.deref).
+    prime() копит id по всему обработчику, load() делает один $in запрос на коллекцию
+    (запросы к разным коллекциям выполняются параллельно), загруженные документы
+    хранятся в identity map и повторно не запрашиваются.
+    items - список 'db.collection' или словарь 'db.collection' -> projection, identity map своя для каждой
+    projection, документ с одним набором полей не отдается там, где запрошены другие
+    """
+
+    def __init__(self):
+        self.identity_map = defaultdict(dict)
+        self.queue = defaultdict(set)
+        self.projections = {}
+
+    def _key(self, database, collection, items):
+        projection = None
+        if isinstance(items, dict):
+            projection = items[database + '.' + collection]
+        key = (database, collection, projection_key(projection))
+        self.projections[key] = projection
+        return key
+
+    def prime(self, data, items):
+        for _, _, ref in iter_db_refs(data):
+            if ref.database + '.' + ref.collection not in items:
+                continue
+            key = self._key(ref.database, ref.collection, items)
+            if ref.id not in self.identity_map[key]:
+                self.queue[key].add(ref.id)
+
+    def _fetch(self, key, id_list):
+        db = DBManager(db_name=key[0], collection=key[1])
+        docs = {_id: None for _id in id_list}
+        docs.update({i['_id']: i for i in db.db.find({'_id': {'$in': id_list}}, self.projections.get(key))})
+        return key, docs
+
+    def load(self):
+        queue, self.queue = self.queue, defaultdict(set)
+        tasks = [(key, list(id_list)) for key, id_list in queue.items() if id_list]
+        if len(tasks) == 1:
+            results = [self._fetch(*tasks[0])]
+        else:
+            results = get_executor().map(lambda task: self._fetch(*task), tasks)
+        for key, docs in results:
+            self.identity_map[key].update(docs)
+
+    def deref(self, data, items):
+        # ключи считаются до запроса: драйвер может дополнить переданную projection
+        keys = [self._key(database, collection, items) for database, _, collection in
+                (name.partition('.') for name in items)]
+        self.prime(data, items)
+        self.load()
+        docs = defaultdict(lambda: defaultdict(dict))
+        for key in keys:
+            docs[key[0]][key[1]] = self.identity_map[key]
+        return append_db_ref(data, docs)
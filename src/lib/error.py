@@ -37,6 +37,15 @@ class InvalidIdError(BaseError):
         )
 
 
+class InvalidCursorError(BaseError):
+    def __init__(self):
+        super(InvalidCursorError, self).__init__(
+            "DEFAULT.INVALID_CURSOR_ERROR",
+            'Invalid cursor',
+            400
+        )
+
+
 class AccessDeniedError(BaseError):
     def __init__(self):
         super(AccessDeniedError, self).__init__(
@@ -0,0 +1,147 @@
+import hashlib
+import threading
+import uuid
+
+import falcon
+import six
+
+from lib import db
+from lib.cache import LRUCache, MemcacheCache, TieredCache
+from lib.config import Config
+from lib.main import MetaSingleton
+
+
+def cache_response(ttl, collections=()):
+    """
+    Кешировать GET ответы responder на ttl секунд, collections ('db.collection') - при записи в них
+    через DBManager закешированные ответы перестают отдаваться
+    """
+    def decorator(func):
+        func.cache_ttl = ttl
+        func.cache_collections = tuple(collections)
+        return func
+    return decorator
+
+
+def make_etag(body):
+    if isinstance(body, six.text_type):
+        body = body.encode('utf-8')
+    return '"{}"'.format(hashlib.md5(body).hexdigest())
+
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    tags = [i.strip() for i in header.split(',')]
+    return etag in tags or 'W/' + etag in tags
+
+
+def auth_scope(req):
+    """
+    Область авторизации по умолчанию - заголовок Authorization
+    """
+    token = req.get_header('Authorization')
+    return hashlib.md5(token.encode('utf-8')).hexdigest() if token else ''
+
+
+@six.add_metaclass(MetaSingleton)
+class ResponseCache(object):
+    """
+    Кеш сериализованных ответов для HttpCacheMiddleware: LRU воркера (HTTP_CACHE_SIZE, не дольше
+    HTTP_CACHE_LOCAL_TTL) перед memcache (MEMCACHE_SERVERS). В ключ входит поколение каждой коллекции маршрута,
+    запись через DBManager меняет поколение (lib.db.write_hooks). Без memcache поколения свои в каждом процессе
+    """
+
+    def __init__(self):
+        config = Config()
+        self.default_ttl = config.get_as_int('HTTP_CACHE_TTL', 0)
+        remote, self.remote_generations = None, None
+        if config.get_as_list('MEMCACHE_SERVERS'):
+            remote = MemcacheCache(prefix='http:')
+            self.remote_generations = MemcacheCache(prefix='httpgen:')
+        self.cache = TieredCache(
+            LRUCache(config.get_as_int('HTTP_CACHE_SIZE', 1000)), remote,
+            local_ttl=config.get_as_int('HTTP_CACHE_LOCAL_TTL', 5)
+        )
+        self.generations = {}
+        self.lock = threading.Lock()
+        db.write_hooks.append(self.invalidate)
+
+    def get_generations(self, collections):
+        if not collections:
+            return []
+        if self.remote_generations is None:
+            with self.lock:
+                return [self.generations.setdefault(i, '0') for i in collections]
+        found = self.remote_generations.get_many(list(collections))
+        missing = dict((i, uuid.uuid4().hex) for i in collections if i not in found)
+        if missing:
+            # поколение могло быть вытеснено из memcache, старые ответы не должны найтись снова
+            self.remote_generations.set_many(missing)
+            found.update(missing)
+        return [found[i] for i in collections]
+
+    def invalidate(self, db_name, collection_name):
+        name = db_name + '.' + collection_name
+        with self.lock:
+            self.generations[name] = uuid.uuid4().hex
+        if self.remote_generations is not None:
+            self.remote_generations.set(name, self.generations[name])
+
+    def key(self, req, collections, scope):
+        parts = [req.path, req.query_string or '', scope] + self.get_generations(collections)
+        return hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, entry, ttl):
+        self.cache.set(key, entry, ttl)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class HttpCacheMiddleware(object):
+    """
+    Отдает закешированные GET ответы без вызова ресурса, ставит сильный ETag и отвечает 304 на If-None-Match.
+    Кешируются только responder с cache_response (или все GET при HTTP_CACHE_TTL), потоковые ответы не кешируются
+    """
+
+    def __init__(self, cache=None, scope=auth_scope):
+        self.cache = cache or ResponseCache()
+        self.scope = scope
+
+    def process_resource(self, req, resp, resource, params):
+        if req.method != 'GET' or resource is None:
+            return
+        responder = getattr(resource, 'on_get', None)
+        ttl = getattr(responder, 'cache_ttl', None) or self.cache.default_ttl
+        if not ttl:
+            return
+        key = self.cache.key(req, getattr(responder, 'cache_collections', ()), self.scope(req))
+        entry = self.cache.get(key)
+        if entry is None:
+            req.context['http_cache'] = (key, ttl)
+            return
+        headers = {'ETag': entry['etag'], 'X-Cache': 'HIT'}
+        if etag_matches(req.get_header('If-None-Match'), entry['etag']):
+            raise falcon.HTTPStatus(falcon.HTTP_304, headers=headers)
+        if entry['content_type']:
+            headers['Content-Type'] = entry['content_type']
+        raise falcon.HTTPStatus(falcon.HTTP_200, headers=headers, body=entry['body'])
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        item = req.context.get('http_cache')
+        if item is None or not req_succeeded or resp.status != falcon.HTTP_200 or resp.body is None:
+            return
+        key, ttl = item
+        etag = make_etag(resp.body)
+        self.cache.set(key, {'body': resp.body, 'etag': etag, 'content_type': resp.content_type}, ttl)
+        resp.etag = etag
+        resp.set_header('X-Cache', 'MISS')
+        if etag_matches(req.get_header('If-None-Match'), etag):
+            resp.status = falcon.HTTP_304
+            resp.body = None
@@ -2,6 +2,7 @@
 
 import collections
 import functools
+import threading
 from collections import defaultdict
 import phonenumbers
 from bson import ObjectId
@@ -10,6 +11,8 @@ from marshmallow import fields, validate, Schema
 from webargs import argmap2schema
 from webargs.falconparser import parser, status_map
 
+from lib import serializer
+
 fields = fields
 validate = validate
 Schema = Schema
@@ -22,16 +25,66 @@ def get_response_from_view_args(*args, **kwargs):
         return args[2]
 
 
-def use_schema(schema, callback=None, use_mock=False):
+STREAM_JSON = 'json'
+STREAM_NDJSON = 'ndjson'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def is_list_schema(schema):
+    return isinstance(schema._declared_fields.get('objects'), fields.List)
+
+
+def stream_list_result(schema, result, mode=STREAM_JSON, compiled=False):
+    """
+    Сериализует объекты списка по одному (objects может быть курсором) и отдает JSON кусками,
+    для ndjson - по объекту на строку без обертки
+    """
+    schema = serializer.get_schema_instance(schema)
+    item_field = schema.fields['objects'].container
+    serialize_item = serializer.compile_value(item_field) if compiled else item_field._serialize
+    json_module = schema.opts.json_module
+    envelope = dict(result)
+    objects = envelope.pop('objects', None) or []
+    buffer = []
+    size = 0
+    if mode == STREAM_JSON:
+        head = json_module.dumps(schema.dump(envelope).data)
+        buffer.append(head[:-1] + (', ' if head != '{}' else '') + '"objects": [')
+    separator = '\n' if mode == STREAM_NDJSON else ', '
+    first = True
+    for obj in objects:
+        chunk = json_module.dumps(serialize_item(obj, 'objects', result))
+        if mode == STREAM_NDJSON:
+            chunk += separator
+        elif not first:
+            chunk = separator + chunk
+        first = False
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            size = 0
+    if mode == STREAM_JSON:
+        buffer.append(']}')
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+
+def use_schema(schema, callback=None, use_mock=False, stream=None, compiled=False):
     """
     Если указан callback - schema должен быть словарем
     callback принимает в качестве аргумента результат и возвращает ключ словаря schema (какую схему использовать)
+    stream (STREAM_JSON или STREAM_NDJSON) - списки (схемы с полем objects, см. make_list_schema) отдаются
+    потоком через resp.stream, для ndjson total и next передаются в заголовках X-Total-Count и X-Next-Cursor
+    compiled - сериализовать функцией, собранной lib.serializer.compile_schema
     """
     if callback is not None and not isinstance(schema, dict):
         raise ValueError('If callback, schema must be dictionary')
 
     def decorator(func):
         func.schema = schema
+        func.compiled = compiled
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
@@ -41,45 +94,175 @@ def use_schema(schema, callback=None, use_mock=False):
                 _schema = schema[callback(result)]
             else:
                 _schema = schema
-            resp_obj.body = _schema().dumps(result).data
+            if stream is not None and isinstance(result, dict) and is_list_schema(_schema):
+                if stream == STREAM_NDJSON:
+                    resp_obj.content_type = 'application/x-ndjson'
+                    if result.get('total') is not None:
+                        resp_obj.set_header('X-Total-Count', str(result['total']))
+                    if result.get('next') is not None:
+                        resp_obj.set_header('X-Next-Cursor', result['next'])
+                resp_obj.stream = stream_list_result(_schema, result, stream, compiled)
+            else:
+                resp_obj.body = serializer.dumps(_schema, result, compiled)
 
         return wrapper
 
     return decorator
 
 
+_schema_registry = {}
+_schema_registry_lock = threading.Lock()
+
+
+def _freeze(value):
+    """
+    Хешируемый ключ по структуре аргументов: словари и списки - по содержимому,
+    поля и валидаторы marshmallow - по классу и атрибутам
+    """
+    if isinstance(value, dict):
+        return dict, tuple(sorted(((k, _freeze(v)) for k, v in value.items()), key=lambda i: repr(i[0])))
+    if isinstance(value, (list, tuple)):
+        return list, tuple(_freeze(i) for i in value)
+    if isinstance(value, fields.Field):
+        ignored = ('parent', 'name', '_creation_index')
+        return type(value), _freeze({k: v for k, v in vars(value).items() if k not in ignored})
+    if isinstance(value, validate.Validator):
+        return type(value), _freeze(vars(value))
+    hash(value)
+    return value
+
+
+def memoize_schema(kind, factory, *args, **kwargs):
+    """
+    Один и тот же класс схемы для одинаковых аргументов (make_list_schema, argmap2schema),
+    чтобы не создавать и не регистрировать в marshmallow новые классы на каждый запрос
+    """
+    try:
+        key = (kind, _freeze(args), _freeze(kwargs))
+    except TypeError:
+        return factory(*args, **kwargs)
+    schema = _schema_registry.get(key)
+    if schema is None:
+        with _schema_registry_lock:
+            schema = _schema_registry.get(key)
+            if schema is None:
+                schema = _schema_registry[key] = factory(*args, **kwargs)
+    return schema
+
+
+def _warm_up_field(field, seen):
+    if isinstance(field, Nested) and field.nested_fields is not None:
+        for nested_field in field.nested_fields.values():
+            _warm_up_field(nested_field, seen)
+    elif isinstance(field, fields.Nested):
+        _warm_up_instance(field.schema, seen)
+    elif isinstance(field, fields.List):
+        _warm_up_field(field.container, seen)
+
+
+def _warm_up_instance(schema, seen):
+    if id(schema) in seen:
+        return
+    seen.add(id(schema))
+    for field in schema.fields.values():
+        _warm_up_field(field, seen)
+
+
+def warm_up_schemas(routes):
+    """
+    Заранее создает экземпляры (и, для use_schema(compiled=True), сериализаторы) всех схем,
+    указанных в use_schema у обработчиков routes (см. lib.api.CustomAPI.routes)
+    """
+    count = 0
+    for uri_template, resource in routes:
+        for name in dir(resource):
+            if not name.startswith('on_'):
+                continue
+            responder = getattr(resource, name)
+            schema = getattr(responder, 'schema', None)
+            if schema is None:
+                continue
+            for _schema in (schema.values() if isinstance(schema, dict) else [schema]):
+                _warm_up_instance(serializer.get_schema_instance(_schema), set())
+                if getattr(responder, 'compiled', False):
+                    serializer.compile_schema(_schema)
+                count += 1
+    return count
+
+
 class Nested(fields.Nested):
     """
     Кастомное поле Nested, для использования с множественными схемами
     Если указан callback - nested должен быть словарем
     callback принимает в качестве аргумента результат и возвращает ключ словаря nested (какую схему использовать)
+    Для каждого ключа заранее создается свое поле Nested со своим экземпляром схемы,
+    при сериализации общее состояние не меняется
     """
 
     def __init__(self, nested, callback=None, *args, **kwargs):
-        self.callback = None
+        self.callback = callback
+        self.nested_fields = None
         if callback is not None:
-            self.callback = callback
-            nested = {a: self.__argmap2schema(b) for a, b in nested.items()}
-            self._nested = nested
+            self.nested_fields = {
+                a: fields.Nested(self.__argmap2schema(b), *args, **kwargs) for a, b in nested.items()
+            }
+            nested = {a: b.nested for a, b in self.nested_fields.items()}
         else:
             nested = self.__argmap2schema(nested)
         super(Nested, self).__init__(nested, *args, **kwargs)
 
     def __argmap2schema(self, schema):
         if isinstance(schema, dict):
-            schema = argmap2schema(schema)
+            schema = memoize_schema('argmap', argmap2schema, schema)
         return schema
 
+    def _add_to_schema(self, field_name, schema):
+        super(Nested, self)._add_to_schema(field_name, schema)
+        if self.nested_fields is not None:
+            for field in self.nested_fields.values():
+                field._add_to_schema(field_name, schema)
+                field.schema
+
+    def get_nested_field(self, nested_obj):
+        field = self.nested_fields[self.callback(nested_obj)]
+        if field.parent is None:
+            # поле внутри fields.List не получает _add_to_schema
+            field.parent = self.parent
+            field.name = self.name
+        return field
+
+    def compile_serializer(self, seen, resolve=None):
+        if self.callback is None:
+            return serializer.compile_nested(self, seen, resolve)
+        callback = self.callback
+        compiled = {}
+        for key, field in self.nested_fields.items():
+            if field.parent is None:
+                field.parent = self.parent
+                field.name = self.name
+            resolve_key = None if resolve is None else functools.partial(self._resolve_nested_field, resolve, key)
+            compiled[key] = serializer.compile_value(field, seen, resolve_key)
+
+        def serialize(nested_obj, attr, obj):
+            return compiled[callback(nested_obj)](nested_obj, attr, obj)
+        return serialize
+
+    @staticmethod
+    def _resolve_nested_field(resolve, key):
+        field = resolve()
+        nested_field = field.nested_fields[key]
+        if nested_field.parent is None:
+            nested_field.parent = field.parent
+            nested_field.name = field.name
+        return nested_field
+
     def _serialize(self, nested_obj, attr, obj):
         if self.callback is not None:
-            self.__schema = None
-            self.nested = self._nested[self.callback(nested_obj)]
-        result = super(Nested, self)._serialize(nested_obj, attr, obj)
-        if self.callback is not None:
-            self.nested = self._nested
-        return result
+            return self.get_nested_field(nested_obj)._serialize(nested_obj, attr, obj)
+        return super(Nested, self)._serialize(nested_obj, attr, obj)
 
 
+@serializer.register_text_field
 class MongoId(fields.String):
     def _serialize(self, value, attr, obj):
         return super(MongoId, self)._serialize(value, attr, obj)
@@ -92,6 +275,7 @@ class MongoId(fields.String):
             self.fail('invalid')
 
 
+@serializer.register_text_field
 class Identity(fields.String):
 
     def _serialize(self, value, attr, obj):
@@ -113,6 +297,7 @@ class Identity(fields.String):
         self.fail('invalid')
 
 
+@serializer.register_text_field
 class Password(fields.String):
     def _serialize(self, value, attr, obj):
         return super(Password, self)._serialize(value, attr, obj)
@@ -136,14 +321,20 @@ class OKSchema(Schema):
     ok = fields.Boolean()
 
 
-def make_list_schema(schema, *args, **kwargs):
+def _make_list_schema(schema, *args, **kwargs):
     class _Shema(Schema):
-        total = fields.Integer()
+        total = fields.Integer(allow_none=True)
+        next = fields.String(allow_none=True)
         objects = fields.List(Nested(schema, *args, **kwargs))
 
     return _Shema
 
 
+def make_list_schema(schema, *args, **kwargs):
+    return memoize_schema('list', _make_list_schema, schema, *args, **kwargs)
+
+
 skip_limit_args = {'skip': fields.Integer(), 'limit': fields.Integer()}
+keyset_args = {'after': fields.String(), 'limit': fields.Integer()}
 
 fields.MongoId = MongoId
\ No newline at end of file
@@ -1,7 +1,16 @@
+import logging
 import multiprocessing
+import os
+import signal
+import time
 from six import iteritems
 import gunicorn.app.base
 
+from lib.amqp import ChannelPool
+from lib.db import Database
+
+logger = logging.getLogger(__name__)
+
 
 def number_of_workers():
     return (multiprocessing.cpu_count() * 2) + 1
@@ -17,6 +26,114 @@ class StandaloneApplication(gunicorn.app.base.BaseApplication):
                        if key in self.cfg.settings and value is not None])
         for key, value in iteritems(config):
             self.cfg.set(key.lower(), value)
+        # gunicorn проверяет число аргументов хука, поэтому функция, а не связанный метод
+        user_post_fork = self.options.get('post_fork')
+
+        def post_fork(server, worker):
+            Database().reset()
+            ChannelPool.reset_all()
+            if user_post_fork is not None:
+                user_post_fork(server, worker)
+        self.cfg.set('post_fork', post_fork)
 
     def load(self):
-        return self.application
\ No newline at end of file
+        return self.application
+
+class Supervisor(object):
+    """
+    Запускает processes дочерних процессов на каждого потребителя из consumers (имя -> фабрика объекта
+    со start/stop, например lib.amqp.Server), упавшие перезапускает с нарастающей задержкой.
+    SIGTERM/SIGINT пересылается детям: они отменяют подписки, дожидаются подтверждения сообщений в работе
+    и выходят, через shutdown_timeout оставшиеся получают SIGKILL
+    """
+
+    def __init__(self, consumers, processes=None, max_backoff=60, shutdown_timeout=40, poll_interval=0.5):
+        self.consumers = consumers
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_backoff = max_backoff
+        self.shutdown_timeout = shutdown_timeout
+        self.poll_interval = poll_interval
+        self.children = {}
+        self.started = {}
+        self.failures = {}
+        self.restarts = {}
+        self.stopping = None
+        self.killed = False
+
+    def run_child(self, name):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        Database().reset()
+        ChannelPool.reset_all()
+        consumer = self.consumers[name]()
+        signal.signal(signal.SIGTERM, lambda signum, frame: consumer.stop())
+        consumer.start()
+
+    def spawn(self, name, slot):
+        pid = os.fork()
+        if pid == 0:
+            self.children = {}
+            code = 0
+            try:
+                self.run_child(name)
+            except BaseException:
+                logger.exception('Consumer %s crashed', name)
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = (name, slot)
+        self.started[(name, slot)] = time.time()
+        logger.info('Consumer %s #%s started with pid %s', name, slot, pid)
+
+    def handle_signal(self, signum, frame):
+        if self.stopping is None:
+            self.stopping = time.time()
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if pid == 0:
+                return
+            child = self.children.pop(pid, None)
+            if child is None or self.stopping is not None:
+                continue
+            uptime = time.time() - self.started[child]
+            failures = 1 if uptime > self.max_backoff else self.failures.get(child, 0) + 1
+            self.failures[child] = failures
+            delay = min(2 ** (failures - 1), self.max_backoff)
+            self.restarts[child] = time.time() + delay
+            logger.warning('Consumer %s #%s (pid %s) exited with status %s, restart in %ss',
+                           child[0], child[1], pid, status, delay)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        for name in self.consumers:
+            for slot in range(self.processes):
+                self.spawn(name, slot)
+        while self.children or (self.restarts and self.stopping is None):
+            time.sleep(self.poll_interval)
+            self.reap()
+            if self.stopping is not None:
+                if not self.killed and time.time() - self.stopping > self.shutdown_timeout:
+                    self.killed = True
+                    for pid in list(self.children):
+                        logger.warning('Consumer pid %s did not stop in time, killing', pid)
+                        try:
+                            os.kill(pid, signal.SIGKILL)
+                        except OSError:
+                            pass
+                continue
+            now = time.time()
+            for child, restart_at in list(self.restarts.items()):
+                if restart_at <= now:
+                    del self.restarts[child]
+                    self.spawn(*child)
+        logger.info('All consumers stopped')
@@ -0,0 +1,203 @@
+# coding=utf-8
+import threading
+
+import six
+from marshmallow import Schema, fields, missing, utils
+from marshmallow.exceptions import ValidationError
+
+_compiled = {}
+_compile_lock = threading.Lock()
+_local = threading.local()
+
+# поля, у которых _serialize совпадает с fields.String._serialize, см. register_text_field
+TEXT_FIELDS = {fields.String}
+
+
+def register_text_field(field_class):
+    TEXT_FIELDS.add(field_class)
+    return field_class
+
+
+def get_schema_instance(schema):
+    """
+    Экземпляр схемы, переиспользуемый внутри потока
+    """
+    instances = getattr(_local, 'instances', None)
+    if instances is None:
+        instances = _local.instances = {}
+    instance = instances.get(schema)
+    if instance is None:
+        instance = instances[schema] = schema()
+    return instance
+
+
+def _serialize_text(value, attr, obj):
+    if value is None:
+        return None
+    return utils.ensure_text_type(value)
+
+
+def _fallback(field, resolve):
+    """
+    field._serialize для полей без компиляции. resolve возвращает то же поле у экземпляра схемы текущего
+    потока: marshmallow меняет состояние полей и вложенных схем при dump, общий экземпляр использовать нельзя
+    """
+    if resolve is None:
+        return field._serialize
+    return lambda value, attr, obj: resolve()._serialize(value, attr, obj)
+
+
+def _child(resolve, getter):
+    if resolve is None:
+        return None
+    return lambda: getter(resolve())
+
+
+def compile_nested(field, seen, resolve=None):
+    if isinstance(field.only, six.string_types):
+        return None
+    schema = field.schema
+    dump = _compile_instance(schema, seen, _child(resolve, lambda i: i.schema))
+    if dump is None:
+        return None
+    if field.many:
+        def serialize(value, attr, obj):
+            if value is None:
+                return None
+            return [dump(i) for i in value]
+    else:
+        def serialize(value, attr, obj):
+            if value is None:
+                return None
+            return dump(value)
+    return serialize
+
+
+def _compile_list(field, seen, resolve):
+    container = compile_value(field.container, seen, _child(resolve, lambda i: i.container))
+
+    def serialize(value, attr, obj):
+        if value is None:
+            return None
+        if utils.is_collection(value):
+            return [container(each, attr, obj) for each in value]
+        return [container(value, attr, obj)]
+    return serialize
+
+
+def compile_value(field, seen=None, resolve=None):
+    """
+    Функция (value, attr, obj) -> результат, эквивалентная field._serialize.
+    resolve - функция, возвращающая это поле у экземпляра схемы текущего потока (см. _fallback)
+    """
+    seen = set() if seen is None else seen
+    serialize = None
+    if hasattr(field, 'compile_serializer'):
+        serialize = field.compile_serializer(seen, resolve)
+    elif type(field) in TEXT_FIELDS:
+        serialize = _serialize_text
+    elif type(field) is fields.Nested:
+        serialize = compile_nested(field, seen, resolve)
+    elif type(field) is fields.List:
+        serialize = _compile_list(field, seen, resolve)
+    return serialize or _fallback(field, resolve)
+
+
+def _compile_getter(attr):
+    if '.' in attr:
+        return lambda obj: utils.get_value(attr, obj, missing)
+
+    def getter(obj):
+        try:
+            return obj[attr]
+        except (KeyError, AttributeError, IndexError, TypeError):
+            try:
+                value = getattr(obj, attr)
+                return value() if callable(value) else value
+            except AttributeError:
+                return missing
+    return getter
+
+
+def _compile_field(name, field, seen, resolve):
+    key = field.dump_to or name
+    if not field._CHECK_ATTRIBUTE or field.default is not missing:
+        if resolve is None:
+            return key, lambda obj: field.serialize(name, obj)
+        return key, lambda obj: resolve().serialize(name, obj)
+    getter = _compile_getter(field.attribute or name)
+    serialize = compile_value(field, seen, resolve)
+
+    def dump_field(obj):
+        value = getter(obj)
+        if value is missing:
+            return missing
+        return serialize(value, name, obj)
+    return key, dump_field
+
+
+def _is_compilable(schema):
+    return (
+        not schema._has_processors and not schema.extra and not schema.prefix and
+        type(schema).get_attribute is Schema.get_attribute and schema.__accessor__ is None
+    )
+
+
+def _field_resolver(resolve, name):
+    return _child(resolve, lambda schema: schema.fields[name])
+
+
+def _compile_instance(schema, seen, resolve=None):
+    if not _is_compilable(schema) or type(schema) in seen:
+        return None
+    seen = seen | {type(schema)}
+    dict_class = schema.dict_class
+    items = [_compile_field(name, field, seen, _field_resolver(resolve, name)) for name, field in schema.fields.items()
+             if not getattr(field, 'load_only', False)]
+
+    def dump(obj):
+        result = []
+        for key, dump_field in items:
+            value = dump_field(obj)
+            if value is not missing:
+                result.append((key, value))
+        return dict_class(result)
+    return dump
+
+
+def compile_schema(schema):
+    """
+    Собирает для класса схемы функцию obj -> dict с тем же результатом, что schema().dump(obj).data,
+    без общего диспетчера marshmallow. Для схем с pre/post_dump, extra, prefix или своим get_attribute,
+    а также при ошибке сериализации используется обычный dump
+    """
+    compiled = _compiled.get(schema)
+    if compiled is not None:
+        return compiled
+    with _compile_lock:
+        compiled = _compiled.get(schema)
+        if compiled is not None:
+            return compiled
+        instance = get_schema_instance(schema)
+        dump = _compile_instance(instance, set(), lambda: get_schema_instance(schema))
+        if dump is not None and instance.many:
+            one = dump
+            dump = lambda obj: [one(i) for i in obj] if obj is not None else None
+
+        def serialize(obj):
+            if dump is not None:
+                try:
+                    return dump(obj)
+                except ValidationError:
+                    pass
+            return get_schema_instance(schema).dump(obj).data
+        serialize.json_module = instance.opts.json_module
+        _compiled[schema] = serialize
+        return serialize
+
+
+def dumps(schema, obj, compiled=False):
+    if compiled:
+        serialize = compile_schema(schema)
+        return serialize.json_module.dumps(serialize(obj))
+    return get_schema_instance(schema).dumps(obj).data
@@ -1,11 +1,11 @@
 import datetime
+import functools
 import hashlib
 from random import randint
 
 from bson import DBRef
 from bson import ObjectId
 from bson.errors import InvalidId
-from collections import defaultdict
 
 from lib.error import InvalidIdError
 
@@ -40,54 +40,112 @@ def to_oid(value):
         raise InvalidIdError()
 
 
-def get_from_dict(data, path):
-    path = path.split('.')
-    if len(path) == 1:
-        try:
-            return data.get(path[0])
-        except AttributeError:
+class KeyPath(object):
+    __slots__ = ('path', 'parts')
+
+    def __init__(self, path):
+        self.path = path
+        self.parts = tuple(path.split('.'))
+
+    def get(self, data):
+        for part in self.parts:
+            if data is None:
+                return None
             try:
-                return getattr(data, path[0])
+                data = data.get(part)
             except AttributeError:
-                return None
-    else:
-        try:
-            data = data.get(path[0])
-        except AttributeError:
-            data = getattr(data, path[0])
-        return get_from_dict(data, '.'.join(path[1:]))
+                data = getattr(data, part, None)
+        return data
+
+
+class KeyPathExtractor(object):
+    """
+    Набор путей вида 'a.b.c', разобранный один раз.
+    extract() собирает вложенный словарь только из запрошенных ключей (отсутствующие - None),
+    пути, вложенные в другой запрошенный путь, при сборке пропускаются
+    """
+
+    def __init__(self, paths):
+        self.paths = tuple(KeyPath(i) for i in paths)
+        self._extract_paths = []
+        for path in sorted(self.paths, key=lambda i: i.parts):
+            if not any(path.parts[:len(i.parts)] == i.parts for i in self._extract_paths):
+                self._extract_paths.append(path)
+
+    def extract(self, data):
+        result = {}
+        for path in self._extract_paths:
+            node = result
+            for part in path.parts[:-1]:
+                node = node.setdefault(part, {})
+            node[path.parts[-1]] = path.get(data)
+        return result
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_key_path(path):
+    return KeyPath(path)
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_key_paths(paths):
+    return KeyPathExtractor(paths)
+
+
+def compile_key_paths(paths):
+    return _compile_key_paths(tuple(sorted(set(paths))))
+
+
+def get_from_dict(data, path):
+    return compile_key_path(path).get(data)
+
+
+def _db_ref_kwargs(ref):
+    # дополнительные поля DBRef (например _extra) хранятся только в приватном атрибуте
+    return getattr(ref, '_DBRef__kwargs', None)
+
+
+def iter_db_refs(data):
+    """
+    Итеративно обходит dict/list (включая поля DBRef) и отдает (container, key, ref)
+    для каждого найденного DBRef, container[key] можно заменить на месте
+    """
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            items = node.items()
+        elif isinstance(node, list):
+            items = enumerate(node)
+        else:
+            continue
+        for key, value in items:
+            if isinstance(value, DBRef):
+                yield node, key, value
+                kwargs = _db_ref_kwargs(value)
+                if kwargs:
+                    stack.append(kwargs)
+            elif isinstance(value, (list, dict)):
+                stack.append(value)
 
 
 def collect_db_ref(items):
-    values = []
-    if isinstance(items, dict):
-        items = items.values()
-    for item in items:
-        if isinstance(item, DBRef):
-            values.append(DBRef(item.collection, item.id, item.database))
-            values += collect_db_ref(item._DBRef__kwargs)
-        elif isinstance(item, (list, dict)):
-            values += collect_db_ref(item)
-    return values
+    return [DBRef(ref.collection, ref.id, ref.database) for _, _, ref in iter_db_refs(items)]
 
 
 def append_db_ref(item, data):
-    if isinstance(item, DBRef):
-        item._DBRef__kwargs = append_db_ref(item._DBRef__kwargs, data)
-        return data[item.database][item.collection].get(item.id) or item
-    elif isinstance(item, list):
-        return [append_db_ref(i, data) for i in item]
-    elif isinstance(item, dict):
-        return {k: append_db_ref(i, data) for k, i in item.items()}
-    return item
+    """
+    Заменяет DBRef на документы из data[database][collection][id] на месте,
+    сначала собирает все ссылки, затем подставляет документы
+    """
+    root = [item]
+    for container, key, ref in list(iter_db_refs(root)):
+        doc = data.get(ref.database, {}).get(ref.collection, {}).get(ref.id)
+        if doc:
+            container[key] = doc
+    return root[0]
 
 
 def deref(data, items):
-    refs = defaultdict(list)
-    for r in set(collect_db_ref(data)):
-        if r.database + '.' + r.collection in items:
-            refs[(r.database, r.collection)].append(r.id)
-    docs = defaultdict(lambda: defaultdict(dict))
-    for key, _id in refs.items():
-        docs[key[0]][key[1]] = {i['_id']: i for i in DB(key[0], key[1]).filter({'_id': {'$in': _id}})}
-    return append_db_ref(data, docs)
\ No newline at end of file
+    from lib.deref import DerefLoader
+    return DerefLoader().deref(data, items)
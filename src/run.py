@@ -3,8 +3,8 @@ from wsgiref import simple_server
 
 import logging
 
-from instances import config, api
-from lib.process import StandaloneApplication, number_of_workers
+from instances import config, api, consumers, denorm_consumer
+from lib.process import StandaloneApplication, Supervisor, number_of_workers
 
 
 @click.group()
@@ -17,6 +17,7 @@ def commands():
 @click.option('--port', default=config.get('PORT', 5000))
 def runserver(host, port):
     logging.info('Starting server {}:{}'.format(host, port))
+    api.warm_up()
     httpd = simple_server.make_server(host, port, api)
     httpd.serve_forever()
 
@@ -29,9 +30,30 @@ def runprod(host, port):
         'bind': '%s:%s' % (host, port),
         'workers': number_of_workers(),
     }
+    api.warm_up()
     StandaloneApplication(api, options).run()
 
 
+@commands.command()
+@click.option('--window', default=None, type=float, help='DENORM_WINDOW by default')
+def rundenorm(window):
+    worker = denorm_consumer(window)
+    logging.info('Starting denorm worker')
+    worker.start()
+
+
+@commands.command()
+@click.option('--processes', default=config.get_as_int('CONSUMER_PROCESSES', 0),
+              help='Processes per consumer, CPU count by default')
+@click.argument('names', nargs=-1)
+def runconsumers(processes, names):
+    unknown = set(names) - set(consumers)
+    if unknown:
+        raise click.BadParameter('Unknown consumers: {}'.format(', '.join(sorted(unknown))))
+    selected = dict((name, consumers[name]) for name in names or consumers)
+    logging.info('Starting consumers %s', ', '.join(selected))
+    Supervisor(selected, processes or None).run()
+
 
 if __name__ == '__main__':
     commands()
\ No newline at end of file
@@ -0,0 +1,34 @@
+import timeit
+
+
+def measure(func, number=100, repeat=5):
+    """
+    Лучшее из repeat время одного вызова func в микросекундах
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def measure_each(func, inputs, repeat=3):
+    """
+    Лучшее из repeat среднее время вызова func на каждом элементе inputs() в микросекундах,
+    inputs собираются до замера (для функций, меняющих аргумент на месте)
+    """
+    best = None
+    for _ in range(repeat):
+        items = inputs()
+        started = timeit.default_timer()
+        for item in items:
+            func(item)
+        elapsed = (timeit.default_timer() - started) / len(items) * 1e6
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(title, rows):
+    """
+    Печатает таблицу: rows - список (название, микросекунды), последняя колонка - ускорение относительно первой строки
+    """
+    print(title)
+    base = rows[0][1]
+    for name, value in rows:
+        print('  {:<40} {:>12.1f} us {:>8.2f}x'.format(name, value, base / value if value else 0))
@@ -0,0 +1,48 @@
+"""
+Кодирование и декодирование тел сообщений lib.codec.MessageCodec: JSON и BSON, со сжатием и без, байт в сообщении.
+Запуск: cd src && python -m tests.bench_codec
+"""
+import datetime
+
+import amqp
+from bson import ObjectId, json_util
+
+from lib.codec import BSONCodec, JSONCodec, MessageCodec
+from tests.bench import measure, report
+
+
+def make_payload(size):
+    objects = [
+        {'_id': ObjectId(), 'name': 'object {}'.format(i), 'created': datetime.datetime(2020, 1, 2, 3, 4, 5),
+         'tags': ['a', 'b', 'c'], 'score': i * 1.5, 'active': bool(i % 2)}
+        for i in range(size)
+    ]
+    return {'args': [], 'kwargs': {'objects': objects, 'total': size}}
+
+
+def main():
+    codecs = [
+        ('JSON', MessageCodec(JSONCodec(json_util), json_util)),
+        ('JSON + deflate', MessageCodec(JSONCodec(json_util), json_util, compress_threshold=1024)),
+        ('BSON', MessageCodec(BSONCodec(), json_util)),
+        ('BSON + deflate', MessageCodec(BSONCodec(), json_util, compress_threshold=1024)),
+    ]
+    for size in (1, 100, 1000):
+        payload = make_payload(size)
+        number = max(1, 2000 // size)
+        encode_rows, decode_rows = [], []
+        print('{} objects, bytes on the wire'.format(size))
+        for name, codec in codecs:
+            body, properties = codec.encode(payload)
+            message = amqp.Message(body, **properties)
+            if codec.decode(message)[0]['kwargs']['total'] != size:
+                raise AssertionError('round trip failed')
+            print('  {:<40} {:>12} bytes'.format(name, len(body)))
+            encode_rows.append((name, measure(lambda: codec.encode(payload), number)))
+            decode_rows.append((name, measure(lambda: codec.decode(message), number)))
+        report('{} objects, encode'.format(size), encode_rows)
+        report('{} objects, decode'.format(size), decode_rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""
+Сериализация списка постов: marshmallow dump против lib.serializer.compile_schema.
+Запуск: cd src && python -m tests.bench_serializer
+"""
+from lib import serializer
+from lib.parser import make_list_schema
+from tests.bench import measure, report
+from tests.test_serializer import PostSchema, make_post
+
+
+def main():
+    schema = make_list_schema(PostSchema)
+    for size in (10, 100, 1000):
+        result = {'objects': [make_post(i) for i in range(size)], 'total': size, 'next': None}
+        instance = serializer.get_schema_instance(schema)
+        expected = instance.dumps(result).data
+        actual = serializer.dumps(schema, result, compiled=True)
+        if actual != expected:
+            raise AssertionError('compiled output differs from marshmallow')
+        number = max(1, 1000 // size)
+        report('{} objects, identical output'.format(size), [
+            ('schema().dump', measure(lambda: schema().dump(result), number)),
+            ('cached instance dump', measure(lambda: instance.dump(result), number)),
+            ('compile_schema', measure(lambda: serializer.compile_schema(schema)(result), number)),
+        ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Выбор endpoint по ключу маршрутизации: перебор регулярных выражений против lib.amqp.TopicTrie.
+Запуск: cd src && python -m tests.bench_topic_trie
+"""
+from lib.amqp import TopicTrie
+from tests.bench import measure, report
+from tests.test_topic_trie import key_pattern
+
+
+def make_keys(count):
+    templates = ('am.service.method_{}', 'am.service.*.item_{}', 'am.other_{}.#')
+    return [templates[i % 3].format(i) for i in range(count)]
+
+
+def main():
+    for count in (10, 100, 1000):
+        keys = make_keys(count)
+        endpoints = [(key, key_pattern(key), key) for key in keys]
+        routing_keys = ['am.service.method_{}'.format(count - 3), 'am.service.x.item_{}'.format(count - 2),
+                        'am.other_{}.a.b'.format(count - 1), 'am.missing.key']
+
+        def regex_dispatch():
+            for routing_key in routing_keys:
+                for key, pattern, endpoint in endpoints:
+                    if pattern.match('.' + routing_key):
+                        break
+
+        uncached = TopicTrie(cache_size=1)
+        cached = TopicTrie()
+        for key in keys:
+            uncached.add(key, key)
+            cached.add(key, key)
+        for routing_key in routing_keys:
+            if cached.match(routing_key)[0] != next((k for k, p, _ in endpoints if p.match('.' + routing_key)), None):
+                raise AssertionError('TopicTrie dispatch differs from regex dispatch')
+        report('{} endpoints, {} routing keys per call'.format(count, len(routing_keys)), [
+            ('regex scan', measure(regex_dispatch, 200)),
+            ('TopicTrie without cache', measure(lambda: [uncached._match(i.split('.')) for i in routing_keys], 200)),
+            ('TopicTrie with cache', measure(lambda: [cached.match(i) for i in routing_keys], 200)),
+        ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Сбор и подстановка DBRef в широких и глубоких документах: прежние рекурсивные функции против lib.utils.
+Запуск: cd src && python -m tests.bench_utils
+"""
+from lib.utils import append_db_ref, collect_db_ref
+from tests.bench import measure, measure_each
+from tests.test_utils import copying_append_db_ref, make_deep, make_docs, make_wide, recursive_collect_db_ref
+
+
+def run_or_none(func, *args):
+    """
+    Прежние рекурсивные функции падают на глубоких документах, вместо времени печатается RecursionError
+    """
+    try:
+        return func(*args)
+    except RecursionError:
+        return None
+
+
+def print_rows(title, rows):
+    print(title)
+    for i in range(0, len(rows), 2):
+        (old_name, old), (new_name, new) = rows[i:i + 2]
+        print('  {:<40} {}'.format(old_name, 'RecursionError' if old is None else '{:>12.1f} us'.format(old)))
+        print('  {:<40} {:>12.1f} us {}'.format(new_name, new, '' if old is None else '{:>8.2f}x'.format(old / new)))
+
+
+def main():
+    cases = [
+        ('wide, 1000 objects', make_wide, 1000, 20),
+        ('wide, 10000 objects', make_wide, 10000, 3),
+        ('deep, 100 levels', make_deep, 100, 50),
+        ('deep, 400 levels', make_deep, 400, 20),
+        ('deep, 5000 levels', make_deep, 5000, 3),
+    ]
+    for title, factory, size, number in cases:
+        data, ids = factory(size)
+        docs = make_docs(ids)
+
+        def inputs():
+            return [factory(size, ids)[0] for _ in range(number)]
+        expected = run_or_none(copying_append_db_ref, factory(size, ids)[0], docs)
+        if expected is not None and append_db_ref(factory(size, ids)[0], docs) != expected:
+            raise AssertionError('in-place append_db_ref differs from the copying one')
+        print_rows(title, [
+            ('recursive collect', run_or_none(measure, lambda: recursive_collect_db_ref(data), number)),
+            ('iter_db_refs collect', measure(lambda: collect_db_ref(data), number)),
+            ('copying append', run_or_none(measure_each, lambda item: copying_append_db_ref(item, docs), inputs)),
+            ('in-place append', measure_each(lambda item: append_db_ref(item, docs), inputs)),
+        ])
+
+
+if __name__ == '__main__':
+    main()
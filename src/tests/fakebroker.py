@@ -0,0 +1,179 @@
+"""
+Брокер AMQP в памяти с интерфейсом соединения py-amqp для тестов lib.amqp: topic маршрутизация, qos,
+basic_consume/cancel, ack/reject с возвратом в очередь, publisher confirms
+"""
+import collections
+import itertools
+import re
+import socket
+import threading
+import time
+
+import amqp
+
+
+class Broker(object):
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queues = {}
+        self.bindings = collections.defaultdict(list)
+        self.consumers = collections.defaultdict(list)
+        self.counter = itertools.count(1)
+
+    def connection(self, **kwargs):
+        return Connection(self)
+
+    def route(self, exchange, routing_key):
+        if exchange == '':
+            return [routing_key]
+        out = []
+        for pattern, queue in self.bindings[exchange]:
+            rx = '^' + re.escape(pattern).replace(r'\*', '[^.]+').replace(r'\#', '.*') + '$'
+            if re.match(rx, routing_key) and queue not in out:
+                out.append(queue)
+        return out
+
+
+Q = collections.namedtuple('Q', 'queue message_count consumer_count')
+
+
+class Channel(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_open = True
+        self.events = collections.defaultdict(set)
+        self.confirm = False
+        self.publish_seq = 0
+        self.prefetch = 0
+        self.inflight = 0
+        self.tags = itertools.count(1)
+        self.unacked = {}
+
+    def exchange_declare(self, *a, **k):
+        pass
+
+    def basic_qos(self, size, count, g):
+        self.prefetch = count
+
+    def queue_declare(self, queue='', exclusive=False, auto_delete=True, **k):
+        with self.broker.cond:
+            if not queue:
+                queue = 'amq.gen-%d' % next(self.broker.counter)
+            self.broker.queues.setdefault(queue, collections.deque())
+        return Q(queue, 0, 0)
+
+    def queue_bind(self, queue, exchange, routing_key=''):
+        with self.broker.cond:
+            if (routing_key, queue) not in self.broker.bindings[exchange]:
+                self.broker.bindings[exchange].append((routing_key, queue))
+
+    def basic_consume(self, queue, consumer_tag='', no_ack=False, callback=None, **k):
+        with self.broker.cond:
+            self.broker.consumers[queue].append((self, callback, no_ack))
+            self.connection.consuming.add(queue)
+        return 'ctag'
+
+    def basic_cancel(self, tag):
+        with self.broker.cond:
+            for q in list(self.broker.consumers):
+                self.broker.consumers[q] = [c for c in self.broker.consumers[q] if c[0] is not self]
+            self.connection.consuming.clear()
+
+    def basic_publish(self, msg, exchange='', routing_key='', **k):
+        if not self.is_open:
+            raise IOError('closed')
+        with self.broker.cond:
+            for q in self.broker.route(exchange, routing_key):
+                m = amqp.Message(msg.body, **msg.properties)
+                m.delivery_info = {'routing_key': routing_key, 'exchange': exchange, 'redelivered': False}
+                self.broker.queues.setdefault(q, collections.deque()).append(m)
+            if self.confirm:
+                self.publish_seq += 1
+                self.connection.pending_acks.append(self.publish_seq)
+            self.broker.cond.notify_all()
+
+    def confirm_select(self, nowait=False):
+        self.confirm = True
+
+    def basic_ack(self, tag, multiple=False):
+        self.inflight -= 1
+        self.connection.acked.append(tag)
+        self.unacked.pop(tag, None)
+
+    def basic_reject(self, tag, requeue):
+        self.inflight -= 1
+        self.connection.rejected.append(tag)
+        with self.broker.cond:
+            q, m = self.unacked.pop(tag)
+            if requeue:
+                m.delivery_info['redelivered'] = True
+                self.broker.queues[q].appendleft(m)
+                self.connection.requeued.append(tag)
+                self.broker.cond.notify_all()
+
+    def close(self):
+        self.is_open = False
+
+    def wait(self):
+        self.connection.drain_events()
+
+
+class Connection(object):
+    def __init__(self, broker):
+        self.broker = broker
+        self.consuming = set()
+        self.channels = []
+        self.pending_acks = []
+        self.acked = []
+        self.rejected = []
+        self.requeued = []
+        self.connected = True
+
+    def channel(self):
+        c = Channel(self)
+        self.channels.append(c)
+        return c
+
+    def is_alive(self):
+        return self.connected
+
+    def _next(self):
+        for q in list(self.consuming):
+            dq = self.broker.queues.get(q)
+            if not dq:
+                continue
+            for ch, cb, no_ack in self.broker.consumers[q]:
+                if ch.connection is self and (no_ack or not ch.prefetch or ch.inflight < ch.prefetch):
+                    m = dq.popleft()
+                    m.channel = ch
+                    m.delivery_info['delivery_tag'] = next(ch.tags)
+                    ch.unacked[m.delivery_info['delivery_tag']] = (q, m)
+                    if not no_ack:
+                        ch.inflight += 1
+                    return cb, m
+        return None
+
+    def drain_events(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self.pending_acks:
+                tag = self.pending_acks.pop(0)
+                for ch in self.channels:
+                    for cb in list(ch.events['basic_ack']):
+                        cb(tag, False)
+                return
+            with self.broker.cond:
+                item = self._next()
+                if item is None:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise socket.timeout()
+                    self.broker.cond.wait(min(remaining, 0.05) if remaining else 0.05)
+                    continue
+            cb, m = item
+            cb(m)
+            return
+
+    def close(self):
+        self.connected = False
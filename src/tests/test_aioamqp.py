@@ -0,0 +1,77 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from lib.aioamqp import AsyncClient, AsyncServer
+from lib.amqp import CallTimeoutError
+from tests.fakebroker import Broker
+
+
+async def double(x):
+    await asyncio.sleep(0.05)
+    return x * 2
+
+
+async def never():
+    await asyncio.sleep(1)
+
+
+def increment(x):
+    return x + 1
+
+
+class AsyncRPCTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = Broker()
+        self.server = AsyncServer(
+            'test', connection_factory=self.broker.connection, prefetch_count=500, poll_interval=0.05
+        )
+        self.server.register_endpoint('double', double)
+        self.server.register_endpoint('increment', increment)
+        self.server.register_endpoint('never', never)
+        self.thread = threading.Thread(target=self.server.start)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = AsyncClient('test', connection_factory=self.broker.connection, timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.thread.join(5)
+
+    def run_in_new_loop(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_concurrent_calls(self):
+        async def main():
+            return await asyncio.gather(*[self.client.call('double', i) for i in range(200)])
+        started = time.time()
+        self.assertEqual(self.run_in_new_loop(main()), [i * 2 for i in range(200)])
+        # обработчики ждут одновременно, а не по очереди
+        self.assertLess(time.time() - started, 2)
+
+    def test_client_is_not_bound_to_a_loop(self):
+        self.assertEqual(self.run_in_new_loop(self.client.call('increment', 1)), 2)
+        self.assertEqual(self.run_in_new_loop(self.client.call('double', 2)), 4)
+
+    def test_timeout(self):
+        with self.assertRaises(CallTimeoutError):
+            self.run_in_new_loop(self.client.request('never', timeout=0.2))
+        self.assertEqual(len(self.client.client.replies.pending), 0)
+
+    def test_publish(self):
+        self.run_in_new_loop(self.client.publish('increment', 1))
+        deadline = time.time() + 5
+        while self.server.get_stats()['acked'] < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.get_stats()['acked'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
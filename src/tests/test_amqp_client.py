@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+import unittest
+from concurrent import futures
+from unittest import mock
+
+from lib.amqp import CallTimeoutError, Client, Server
+from tests.fakebroker import Broker
+
+
+def delayed_echo(value, delay):
+    time.sleep(delay)
+    return value
+
+
+def never():
+    time.sleep(1)
+
+
+class ClientCallTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = Broker()
+        self.server = Server(
+            'test', threaded=True, prefetch_count=50, connection_factory=self.broker.connection, poll_interval=0.05
+        )
+        self.server.register_endpoint('echo', delayed_echo)
+        self.server.register_endpoint('never', never)
+        self.thread = threading.Thread(target=self.server.start)
+        self.thread.daemon = True
+        self.thread.start()
+        deadline = time.time() + 5
+        while not self.server.consumer_tags and time.time() < deadline:
+            time.sleep(0.01)
+        self.client = Client('test', connection_factory=self.broker.connection, timeout=5)
+        self.client.replies.poll_interval = 0.05
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.thread.join(5)
+
+    def test_concurrent_calls_matched_by_correlation_id(self):
+        count = 30
+        # ответы приходят в обратном порядке: первый вызов отвечает последним
+        with futures.ThreadPoolExecutor(count) as executor:
+            results = list(executor.map(lambda i: self.client.call('echo', i, (count - i) * 0.01), range(count)))
+        self.assertEqual(results, list(range(count)))
+        self.assertEqual(self.client.replies.pending, {})
+
+    def test_call_async_futures(self):
+        calls = [self.client.call_async('echo', i, (10 - i) * 0.01) for i in range(10)]
+        self.assertEqual(len(set(i.correlation_id for i in calls)), 10)
+        self.assertEqual([i.result() for i in calls], list(range(10)))
+
+    def test_timeout(self):
+        started = time.time()
+        with self.assertRaises(CallTimeoutError):
+            self.client.request('never', timeout=0.2).result()
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(self.client.replies.pending, {})
+        # запоздавший ответ отбрасывается и не достается следующему вызову
+        time.sleep(1)
+        self.assertEqual(self.client.call('echo', 'next', 0), 'next')
+
+    def test_recovers_after_fork(self):
+        self.assertEqual(self.client.call('echo', 1, 0), 1)
+        replies = self.client.replies
+        queue, thread = replies.queue, replies._thread
+        replies.register('parent', futures.Future())
+        with mock.patch('lib.amqp.os.getpid', return_value=os.getpid() + 1):
+            self.assertEqual(self.client.call('echo', 2, 0), 2)
+            self.assertNotEqual(replies.queue, queue)
+            self.assertIsNot(replies._thread, thread)
+            self.assertNotIn('parent', replies.pending)
+            self.assertEqual(self.client.pool.get_stats()['created'], 1)
+            self.assertEqual(self.client.call('echo', 3, 0), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
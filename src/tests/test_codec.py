@@ -0,0 +1,124 @@
+import datetime
+import json
+import socket
+import threading
+import time
+import unittest
+
+import amqp
+from bson import ObjectId, json_util
+
+from lib.amqp import Client, Server
+from lib.codec import DEFLATE, BSONCodec, JSONCodec, MessageCodec
+from tests.fakebroker import Broker
+
+VALUE = {'args': [1, 'два', [1.5, None, True]], 'kwargs': {'text': 'x' * 500}}
+
+
+def as_message(body, properties):
+    return amqp.Message(body, **properties)
+
+
+def echo(*args, **kwargs):
+    return {'args': list(args), 'kwargs': kwargs}
+
+
+class MessageCodecTestCase(unittest.TestCase):
+
+    def assertRoundTrip(self, codec, value, compressed):
+        body, properties = codec.encode(value)
+        self.assertEqual(properties.get('content_encoding') == DEFLATE, compressed)
+        decoded, used = codec.decode(as_message(body, properties))
+        self.assertEqual(decoded, value)
+        self.assertEqual(used.content_type, properties['content_type'])
+
+    def test_json_round_trip(self):
+        self.assertRoundTrip(MessageCodec(), VALUE, False)
+        self.assertRoundTrip(MessageCodec(compress_threshold=100), VALUE, True)
+
+    def test_bson_round_trip(self):
+        value = dict(VALUE, _id=ObjectId(), created=datetime.datetime(2020, 1, 2, 3, 4, 5, 678000))
+        self.assertRoundTrip(MessageCodec(BSONCodec()), value, False)
+        self.assertRoundTrip(MessageCodec(BSONCodec(), compress_threshold=100), value, True)
+
+    def test_short_body_is_not_compressed(self):
+        self.assertRoundTrip(MessageCodec(compress_threshold=10000), VALUE, False)
+        codec = MessageCodec(compress_threshold=0)
+        body, properties = codec.encode(VALUE, compress=False)
+        self.assertNotIn('content_encoding', properties)
+
+    def test_message_without_content_type_is_json(self):
+        codec = MessageCodec(BSONCodec(), compress_threshold=0)
+        for body in (json.dumps(VALUE), json.dumps(VALUE).encode('utf-8')):
+            decoded, used = codec.decode(amqp.Message(body))
+            self.assertEqual(decoded, VALUE)
+            self.assertIs(used, codec.legacy)
+
+    def test_unknown_content_type_is_json(self):
+        decoded, used = MessageCodec().decode(amqp.Message(json.dumps(VALUE), content_type='text/plain'))
+        self.assertEqual(decoded, VALUE)
+        self.assertIsInstance(used, JSONCodec)
+
+    def test_legacy_codec_uses_dumper(self):
+        value = {'_id': ObjectId()}
+        decoded, _ = MessageCodec(BSONCodec(), json_util).decode(amqp.Message(json_util.dumps(value)))
+        self.assertEqual(decoded, value)
+
+
+class CodecRPCTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = Broker()
+        self.server = Server(
+            'test', connection_factory=self.broker.connection, poll_interval=0.05, codec=BSONCodec(),
+            compress_threshold=100
+        )
+        self.server.register_endpoint('echo', echo)
+        self.thread = threading.Thread(target=self.server.start)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join(5)
+
+    def test_round_trip_with_and_without_deflate(self):
+        value = {'_id': ObjectId(), 'text': 'x' * 500}
+        # json_util возвращает datetime с tzinfo, без преобразований datetime проходит только через BSON
+        bson_value = dict(value, created=datetime.datetime(2020, 1, 2, 3, 4, 5, 678000))
+        cases = [
+            (JSONCodec(json_util), None, value), (JSONCodec(json_util), 10, value),
+            (BSONCodec(), None, bson_value), (BSONCodec(), 10, bson_value),
+        ]
+        for codec, threshold, item in cases:
+            client = Client('test', connection_factory=self.broker.connection, codec=codec,
+                            compress_threshold=threshold)
+            try:
+                self.assertEqual(client.call('echo', 1, value=item), {'args': [1], 'kwargs': {'value': item}})
+            finally:
+                client.close()
+
+    def test_legacy_request_gets_plain_json_reply(self):
+        connection = self.broker.connection()
+        channel = connection.channel()
+        reply_to = channel.queue_declare(exclusive=True).queue
+        replies = []
+        channel.basic_consume(reply_to, no_ack=True, callback=replies.append)
+        body = json.dumps({'args': [1], 'kwargs': {'text': 'x' * 500}})
+        channel.basic_publish(amqp.Message(body, reply_to=reply_to, correlation_id='legacy'), self.server.exchange_name,
+                              routing_key='am.test.echo')
+        deadline = time.time() + 5
+        while not replies and time.time() < deadline:
+            try:
+                connection.drain_events(timeout=0.05)
+            except socket.timeout:
+                pass
+        self.assertEqual(len(replies), 1)
+        self.assertEqual(replies[0].properties.get('correlation_id'), 'legacy')
+        self.assertEqual(replies[0].properties.get('content_type'), JSONCodec.content_type)
+        self.assertNotIn('content_encoding', replies[0].properties)
+        self.assertEqual(json.loads(replies[0].body), {'args': [1], 'kwargs': {'text': 'x' * 500}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from bson import ObjectId
+
+from lib.amqp import Client, Server
+from lib.codec import BSONCodec
+from lib.db import DenormDBManager
+from lib.denorm import DenormPublisher, DenormWorker
+from tests.fakebroker import Broker
+
+
+class FakeCollection(object):
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, projection=None):
+        return [self.docs[i] for i in query['_id']['$in'] if i in self.docs]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class DenormWorkerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = Broker()
+        self.docs = {}
+        self.propagated = []
+        self.failures = 0
+        source = mock.Mock()
+        source.return_value.db = FakeCollection(self.docs)
+        patches = [
+            mock.patch('lib.denorm.DBManager', source),
+            mock.patch.object(DenormDBManager, 'get_projection', return_value={'name': 1}),
+            mock.patch.object(DenormDBManager, 'propagate', autospec=True, side_effect=self.propagate),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.server = Server(
+            'denorm', threaded=True, prefetch_count=100, connection_factory=self.broker.connection,
+            poll_interval=0.05, codec=BSONCodec()
+        )
+        # flush вызывается из теста, фоновый цикл окна не успевает сработать
+        self.worker = DenormWorker(self.server, window=60, retry_delay=0)
+        self.thread = threading.Thread(target=self.worker.start)
+        self.thread.daemon = True
+        self.thread.start()
+        self.assertTrue(wait_for(lambda: self.server.consumer_tags))
+        self.publisher = DenormPublisher(
+            lambda: Client('denorm', connection_factory=self.broker.connection, codec=BSONCodec())
+        )
+
+    def tearDown(self):
+        self.worker.flush()
+        self.worker.stop()
+        self.thread.join(5)
+
+    def propagate(self, denorm_db, db_name, collection_name, changes, generations=None):
+        if self.failures:
+            self.failures -= 1
+            raise ValueError('propagate failed')
+        self.propagated.append((db_name, collection_name, changes))
+
+    def publish(self, _id, old, new):
+        self.publisher.publish('app', 'users', [(_id, old, new)])
+
+    def test_changes_within_window_are_coalesced(self):
+        first, second = ObjectId(), ObjectId()
+        self.docs[first] = {'_id': first, 'name': 'current'}
+        self.docs[second] = {'_id': second, 'name': 'second'}
+        self.publish(first, {'name': 'v1'}, {'name': 'v2'})
+        self.publish(first, {'name': 'v2'}, {'name': 'v3'})
+        self.publish(second, {'name': 'old'}, {'name': 'second'})
+        self.publish(first, {'name': 'v3'}, {'name': 'v4'})
+        self.assertTrue(wait_for(lambda: self.worker.get_stats()['received'] == 4))
+        self.worker.flush()
+        self.assertTrue(wait_for(lambda: self.server.get_stats()['acked'] == 4))
+        # old из первого события, new перечитан из источника
+        self.assertEqual(self.propagated, [('app', 'users', [
+            (first, {'name': 'v1'}, self.docs[first]),
+            (second, {'name': 'old'}, self.docs[second]),
+        ])])
+        stats = self.worker.get_stats()
+        self.assertEqual((stats['coalesced'], stats['applied']), (2, 2))
+
+    def test_ack_after_flush(self):
+        _id = ObjectId()
+        self.docs[_id] = {'_id': _id, 'name': 'new'}
+        self.publish(_id, {'name': 'old'}, {'name': 'new'})
+        self.assertTrue(wait_for(lambda: self.worker.get_stats()['pending'] == 1))
+        time.sleep(0.1)
+        self.assertEqual(self.server.get_stats()['acked'], 0)
+        self.assertEqual(self.server.connection.acked, [])
+        self.worker.flush()
+        self.assertTrue(wait_for(lambda: self.server.get_stats()['acked'] == 1))
+        self.assertEqual(len(self.propagated), 1)
+
+    def test_deleted_documents_are_skipped(self):
+        self.publish(ObjectId(), {'name': 'old'}, {'name': 'new'})
+        self.assertTrue(wait_for(lambda: self.worker.get_stats()['pending'] == 1))
+        self.worker.flush()
+        self.assertTrue(wait_for(lambda: self.server.get_stats()['acked'] == 1))
+        self.assertEqual(self.propagated, [])
+        self.assertEqual(self.worker.get_stats()['deleted'], 1)
+
+    def test_failed_flush_requeues(self):
+        _id = ObjectId()
+        self.docs[_id] = {'_id': _id, 'name': 'new'}
+        self.failures = 1
+        self.publish(_id, {'name': 'old'}, {'name': 'new'})
+        self.assertTrue(wait_for(lambda: self.worker.get_stats()['pending'] == 1))
+        with self.assertLogs('lib', 'ERROR'):
+            self.worker.flush()
+            self.assertTrue(wait_for(lambda: self.server.get_stats()['requeued'] == 1))
+        self.assertEqual(self.server.get_stats()['acked'], 0)
+        self.assertEqual(self.propagated, [])
+        self.assertEqual(self.worker.get_stats()['errors'], 1)
+        # сообщение вернулось в очередь и применяется следующим flush
+        self.assertTrue(wait_for(lambda: self.worker.get_stats()['pending'] == 1))
+        self.worker.flush()
+        self.assertTrue(wait_for(lambda: self.server.get_stats()['acked'] == 1))
+        self.assertEqual(self.propagated, [('app', 'users', [(_id, {'name': 'old'}, self.docs[_id])])])
+        self.assertEqual(len(self.server.connection.requeued), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
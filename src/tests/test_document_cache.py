@@ -0,0 +1,128 @@
+import copy
+import unittest
+
+import pymongo
+from pymemcache.test.utils import MockMemcacheClient
+
+from lib.config import Config
+from lib.db import DBManager, DocumentCache
+from lib.main import MetaSingleton
+
+
+class FakeCollection(object):
+    """
+    Коллекция с primary и отстающей secondary, чтение - по read_preference как у pymongo
+    """
+
+    def __init__(self, primary, secondary, read_preference=pymongo.ReadPreference.SECONDARY_PREFERRED, reads=None):
+        self.primary = primary
+        self.secondary = secondary
+        self.read_preference = read_preference
+        self.reads = [] if reads is None else reads
+
+    def with_options(self, read_preference=None):
+        return FakeCollection(self.primary, self.secondary, read_preference, self.reads)
+
+    def _docs(self):
+        self.reads.append(self.read_preference.name)
+        return self.primary if self.read_preference == pymongo.ReadPreference.PRIMARY else self.secondary
+
+    def find(self, query, projection=None):
+        docs = self._docs()
+        return iter([copy.deepcopy(docs[_id]) for _id in query['_id']['$in'] if _id in docs])
+
+    def find_one(self, query):
+        doc = self._docs().get(query['_id'])
+        return copy.deepcopy(doc)
+
+
+class BrokenMemcacheClient(object):
+
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise IOError('memcache is down')
+        return fail
+
+
+class DocumentCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        config = Config()
+        self.saved = {key: config.get(key) for key in ('DOCUMENT_CACHE', 'MEMCACHE_SERVERS')}
+        config['DOCUMENT_CACHE'] = {'app.users': 60}
+        config['MEMCACHE_SERVERS'] = ['memcache:11211']
+        MetaSingleton._instances.pop(DocumentCache, None)
+        self.memcache = MockMemcacheClient()
+        self.cache = DocumentCache()
+        self.cache.cache.remote.client_factory = lambda: self.memcache
+        self.primary = {1: {'_id': 1, 'name': 'new'}, 2: {'_id': 2, 'name': 'second'}}
+        self.secondary = {1: {'_id': 1, 'name': 'old'}, 2: {'_id': 2, 'name': 'second'}}
+
+    def tearDown(self):
+        MetaSingleton._instances.pop(DocumentCache, None)
+        config = Config()
+        for key, value in self.saved.items():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+
+    def manager(self, collection='users'):
+        manager = DBManager('app', collection)
+        manager._db = FakeCollection(self.primary, self.secondary)
+        return manager
+
+    def new_worker(self):
+        # другой воркер: свой пустой LRU, общий memcache
+        self.cache.cache.local.clear()
+
+    def test_get_by_id_fills_cache_from_primary(self):
+        manager = self.manager()
+        self.assertEqual(manager.get_by_id(1)['name'], 'new')
+        self.assertEqual(manager._db.reads, ['Primary'])
+        self.new_worker()
+        manager._db = FakeCollection({}, {})
+        self.assertEqual(manager.get_by_id(1)['name'], 'new')
+        self.assertEqual(manager._db.reads, [])
+
+    def test_find_by_id_list_keeps_order_and_uses_memcache(self):
+        manager = self.manager()
+        docs = manager.find_by_id_list([2, 1, 3])
+        self.assertIsInstance(docs, list)
+        self.assertEqual([i['name'] for i in docs], ['second', 'new'])
+        self.new_worker()
+        manager._db = FakeCollection({}, {})
+        self.assertEqual([i['_id'] for i in manager.find_by_id_list([1, 2])], [1, 2])
+        self.assertEqual(manager._db.reads, [])
+
+    def test_find_by_id_list_without_cache_returns_list(self):
+        manager = self.manager('posts')
+        self.assertIsNone(manager.cache_ttl)
+        docs = manager.find_by_id_list([1, 2])
+        self.assertIsInstance(docs, list)
+        self.assertEqual([i['name'] for i in docs], ['old', 'second'])
+
+    def test_invalidate_after_write_does_not_restore_stale_document(self):
+        manager = self.manager()
+        manager.get_by_id(1)
+        self.primary[1] = {'_id': 1, 'name': 'newest'}
+        manager.invalidate_cache([1])
+        self.new_worker()
+        self.assertEqual(manager.get_by_id(1)['name'], 'newest')
+        self.new_worker()
+        self.assertEqual(self.cache.get_many('app', 'users', [1])[1]['name'], 'newest')
+
+    def test_cached_document_is_a_copy(self):
+        manager = self.manager()
+        manager.get_by_id(1)['name'] = 'changed'
+        self.assertEqual(manager.get_by_id(1)['name'], 'new')
+
+    def test_memcache_errors_are_misses(self):
+        self.cache.cache.remote.client_factory = lambda: BrokenMemcacheClient()
+        manager = self.manager()
+        self.assertEqual([i['name'] for i in manager.find_by_id_list([1, 2])], ['new', 'second'])
+        self.assertGreater(self.cache.stats()['remote']['errors'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
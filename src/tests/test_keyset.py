@@ -0,0 +1,37 @@
+import base64
+import datetime
+import re
+import unittest
+
+from bson import BSON, ObjectId
+
+from lib.db import decode_keyset_token, encode_keyset_token
+from lib.error import InvalidCursorError
+
+
+def make_token(value, _id):
+    return base64.urlsafe_b64encode(BSON.encode({'v': value, 'i': _id})).decode('ascii')
+
+
+class KeysetTokenTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        _id = ObjectId()
+        for value in ('name', 10, 1.5, True, None, datetime.datetime(2020, 1, 2, 3, 4, 5), ObjectId()):
+            self.assertEqual(decode_keyset_token(encode_keyset_token(value, _id)), (value, _id))
+
+    def test_operator_documents_are_rejected(self):
+        _id = ObjectId()
+        for value, token_id in (({'$ne': None}, _id), ('a', {'$gt': ''}), ([1, 2], _id), ('a', [_id]),
+                                (re.compile('.*'), _id)):
+            with self.assertRaises(InvalidCursorError):
+                decode_keyset_token(make_token(value, token_id))
+
+    def test_malformed_token(self):
+        for token in ('', 'not a token', base64.urlsafe_b64encode(BSON.encode({'v': 1})).decode('ascii')):
+            with self.assertRaises(InvalidCursorError):
+                decode_keyset_token(token)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import datetime
+import json
+import threading
+import unittest
+
+from bson import ObjectId
+
+from lib import serializer
+from lib.parser import DateTimeReplaced, MongoId, Nested, make_list_schema
+from marshmallow import Schema, fields
+
+
+class TagSchema(Schema):
+    name = fields.String()
+    weight = fields.Float()
+
+
+class AuthorSchema(Schema):
+    _id = MongoId()
+    name = fields.String()
+    created = DateTimeReplaced()
+    tags = fields.Nested(TagSchema, many=True)
+
+
+class PostSchema(Schema):
+    _id = MongoId()
+    title = fields.String(dump_to='heading')
+    author = fields.Nested(AuthorSchema)
+    tags = fields.List(fields.String())
+    scores = fields.List(fields.Integer())
+    created = DateTimeReplaced()
+    slug = fields.Method('get_slug')
+    length = fields.Function(lambda obj: len(obj.get('title') or ''))
+    status = fields.String(default='draft')
+    secret = fields.String(load_only=True)
+    editor = fields.String(attribute='meta.editor')
+
+    def get_slug(self, obj):
+        return (obj.get('title') or '').lower().replace(' ', '-')
+
+
+class ImageSchema(Schema):
+    kind = fields.String()
+    url = fields.String()
+
+
+class TextSchema(Schema):
+    kind = fields.String()
+    body = fields.String()
+
+
+class FeedSchema(Schema):
+    items = fields.List(Nested({'image': ImageSchema, 'text': TextSchema}, callback=lambda i: i['kind']))
+    pinned = Nested({'image': ImageSchema, 'text': TextSchema}, callback=lambda i: i['kind'])
+
+
+def make_post(i):
+    return {
+        '_id': ObjectId(),
+        'title': 'Post number {}'.format(i),
+        'author': {
+            '_id': ObjectId(),
+            'name': u'Автор {}'.format(i),
+            'created': datetime.datetime(2020, 1, 2, 3, 4, 5, 678),
+            'tags': [{'name': 'a', 'weight': 1.5}, {'name': 'b', 'weight': 2}],
+        },
+        'tags': ['x', 'y'] if i % 2 else 'single',
+        'scores': [1, 2, 3],
+        'created': datetime.datetime(2021, 5, 6, 7, 8, 9, 123456),
+        'secret': 'hidden',
+        'meta': {'editor': 'ed'},
+    }
+
+
+class CompiledSchemaTestCase(unittest.TestCase):
+
+    def assertSameOutput(self, schema, obj):
+        expected = schema().dump(obj).data
+        actual = serializer.compile_schema(schema)(obj)
+        self.assertEqual(actual, expected)
+        self.assertEqual(json.dumps(actual), json.dumps(expected))
+
+    def test_nested_list_method_function(self):
+        for i in range(4):
+            self.assertSameOutput(PostSchema, make_post(i))
+
+    def test_missing_and_none_values(self):
+        self.assertSameOutput(PostSchema, {'title': None, 'author': None, 'tags': None})
+        self.assertSameOutput(PostSchema, {})
+
+    def test_list_schema(self):
+        schema = make_list_schema(PostSchema)
+        result = {'objects': [make_post(i) for i in range(5)], 'total': 5, 'next': None}
+        self.assertSameOutput(schema, result)
+
+    def test_polymorphic_nested(self):
+        feed = {
+            'items': [{'kind': 'image', 'url': 'u', 'body': 'x'}, {'kind': 'text', 'body': 'b', 'url': 'y'}],
+            'pinned': {'kind': 'text', 'body': 'p'},
+        }
+        self.assertSameOutput(FeedSchema, feed)
+
+    def test_dumps_matches_marshmallow(self):
+        post = make_post(1)
+        self.assertEqual(serializer.dumps(PostSchema, post, compiled=True), PostSchema().dumps(post).data)
+
+    def test_fallback_fields_use_thread_local_schema(self):
+        class TrackedSchema(PostSchema):
+            def get_slug(self, obj):
+                used.append(self)
+                return super(TrackedSchema, self).get_slug(obj)
+        used = []
+        serialize = serializer.compile_schema(TrackedSchema)
+        post = make_post(3)
+        results = []
+
+        def run():
+            results.append(serialize(post))
+            results.append(serializer.get_schema_instance(TrackedSchema))
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(results[0], PostSchema().dump(post).data)
+        # Method вызван у экземпляра схемы потока, а не у экземпляра, по которому собран сериализатор
+        self.assertIs(used[-1], results[1])
+        self.assertIsNot(used[-1], serializer.get_schema_instance(TrackedSchema))
+
+if __name__ == '__main__':
+    unittest.main()
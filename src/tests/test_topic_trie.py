@@ -0,0 +1,95 @@
+import itertools
+import random
+import re
+import unittest
+
+from lib.amqp import TopicTrie
+
+KEYS = [
+    'a.b', 'a.*', '*.b', '*', '*.*', 'a.#', '#', '#.b', 'a.#.c', '#.#', 'a.*.#', '#.*', 'a.b.#', 'a.*.c',
+    'get_*', 'a.get_*', 'a.*_id.c', '*.get_*.#',
+]
+ROUTING_KEYS = [
+    '', 'a', 'b', 'a.b', 'x.b', 'a.b.c', 'a.x.c', 'a..c', 'a.', '.b', 'a.b.c.d', 'a.x.y.c', 'get_user', 'get_',
+    'a.get_user', 'a.get_user.c', 'a.user_id.c', 'a._id.c', 'x.get_user.y.z', 'c', 'a.b.b', 'b.a',
+]
+
+
+def key_pattern(key):
+    """
+    Регулярное выражение прежнего перебора endpoints: '*' внутри сегмента - любые символы кроме точки.
+    '#' прежний перебор не поддерживал, для него добавлено ноль или больше сегментов, ключ сравнивается с '.' + key
+    """
+    parts = []
+    for segment in key.split('.'):
+        if segment == '#':
+            parts.append(r'(?:\.[^.]*)*')
+        else:
+            parts.append(r'\.' + '[^.]*'.join([re.escape(i) for i in segment.split('*')]))
+    return re.compile(r'^{}$'.format(''.join(parts)))
+
+
+def regex_dispatch(keys, routing_key):
+    for key in keys:
+        if key_pattern(key).match('.' + routing_key):
+            return key
+    return None
+
+
+def make_trie(keys):
+    trie = TopicTrie()
+    for key in keys:
+        trie.add(key, key.upper())
+    return trie
+
+
+class TopicTrieTestCase(unittest.TestCase):
+
+    def test_single_key_matches_regex(self):
+        for key, routing_key in itertools.product(KEYS, ROUTING_KEYS):
+            expected = regex_dispatch([key], routing_key)
+            self.assertEqual(make_trie([key]).match(routing_key)[0], expected, (key, routing_key))
+
+    def test_first_registered_wins(self):
+        rnd = random.Random(42)
+        for _ in range(50):
+            keys = rnd.sample(KEYS, rnd.randint(1, len(KEYS)))
+            trie = make_trie(keys)
+            for routing_key in ROUTING_KEYS:
+                key = regex_dispatch(keys, routing_key)
+                self.assertEqual(trie.match(routing_key), (key, key and key.upper()), (keys, routing_key))
+
+    def test_star_is_exactly_one_segment(self):
+        trie = make_trie(['a.*'])
+        self.assertEqual(trie.match('a.b')[0], 'a.*')
+        self.assertEqual(trie.match('a.')[0], 'a.*')
+        self.assertEqual(trie.match('a'), (None, None))
+        self.assertEqual(trie.match('a.b.c'), (None, None))
+
+    def test_hash_is_zero_or_more_segments(self):
+        trie = make_trie(['a.#.c'])
+        for routing_key in ('a.c', 'a.b.c', 'a.b.b.b.c'):
+            self.assertEqual(trie.match(routing_key)[0], 'a.#.c')
+        self.assertEqual(trie.match('a.b'), (None, None))
+
+    def test_duplicate_key_keeps_first_value(self):
+        trie = TopicTrie()
+        trie.add('a.*', 1)
+        trie.add('a.*', 2)
+        self.assertEqual(trie.match('a.b'), ('a.*', 1))
+
+    def test_add_clears_cache(self):
+        trie = make_trie(['a.b.c'])
+        self.assertEqual(trie.match('a.b'), (None, None))
+        trie.add('a.*', 'x')
+        self.assertEqual(trie.match('a.b'), ('a.*', 'x'))
+
+    def test_long_hash_chain(self):
+        key = '.'.join(['#'] * 10 + ['z'])
+        trie = make_trie([key])
+        self.assertEqual(trie.match('.'.join(['x'] * 30 + ['z']))[0], key)
+        self.assertEqual(trie.match('.'.join(['x'] * 30)), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import copy
+import unittest
+from collections import defaultdict
+
+from bson import DBRef, ObjectId
+
+from lib.utils import append_db_ref, collect_db_ref
+
+
+def recursive_collect_db_ref(items):
+    """
+    Прежняя рекурсивная реализация collect_db_ref, эталон для сравнения
+    """
+    values = []
+    if isinstance(items, dict):
+        items = items.values()
+    for item in items:
+        if isinstance(item, DBRef):
+            values.append(DBRef(item.collection, item.id, item.database))
+            values += recursive_collect_db_ref(item._DBRef__kwargs)
+        elif isinstance(item, (list, dict)):
+            values += recursive_collect_db_ref(item)
+    return values
+
+
+def copying_append_db_ref(item, data):
+    """
+    Прежняя реализация append_db_ref, собирающая копию дерева, эталон для сравнения
+    """
+    if isinstance(item, DBRef):
+        item._DBRef__kwargs = copying_append_db_ref(item._DBRef__kwargs, data)
+        return data[item.database][item.collection].get(item.id) or item
+    elif isinstance(item, list):
+        return [copying_append_db_ref(i, data) for i in item]
+    elif isinstance(item, dict):
+        return {k: copying_append_db_ref(i, data) for k, i in item.items()}
+    return item
+
+
+def make_docs(ids):
+    docs = defaultdict(lambda: defaultdict(dict))
+    for i, _id in enumerate(ids):
+        if i % 3:
+            docs['app']['users'][_id] = {'_id': _id, 'name': 'user {}'.format(i)}
+    return docs
+
+
+def make_wide(size, ids=None):
+    ids = ids or [ObjectId() for _ in range(size)]
+    data = {
+        'objects': [
+            {'_id': i, 'author': DBRef('users', _id, 'app'), 'tags': ['a', 'b'],
+             'editor': DBRef('users', ids[0], 'app', _extra={'owner': DBRef('users', ids[-1], 'app')})}
+            for i, _id in enumerate(ids)
+        ],
+        'total': size,
+    }
+    return data, ids
+
+
+def make_deep(depth, ids=None):
+    ids = ids or [ObjectId() for _ in range(depth)]
+    data = node = {}
+    for _id in ids:
+        child = {}
+        node['ref'] = DBRef('users', _id, 'app')
+        node['items'] = [child, 1, 'x']
+        node = child
+    return data, ids
+
+
+class DBRefTraversalTestCase(unittest.TestCase):
+
+    def assertSameAsCopying(self, data, ids):
+        docs = make_docs(ids)
+        expected = copying_append_db_ref(copy.deepcopy(data), docs)
+        self.assertEqual(append_db_ref(copy.deepcopy(data), docs), expected)
+
+    def test_collect_wide(self):
+        data, _ = make_wide(200)
+        self.assertEqual(sorted(map(repr, collect_db_ref(data))), sorted(map(repr, recursive_collect_db_ref(data))))
+
+    def test_collect_deep(self):
+        data, _ = make_deep(200)
+        self.assertEqual(sorted(map(repr, collect_db_ref(data))), sorted(map(repr, recursive_collect_db_ref(data))))
+
+    def test_append_wide_matches_copying(self):
+        self.assertSameAsCopying(*make_wide(200))
+
+    def test_append_deep_matches_copying(self):
+        self.assertSameAsCopying(*make_deep(200))
+
+    def test_append_top_level_ref(self):
+        _id = ObjectId()
+        docs = make_docs([ObjectId(), _id])
+        self.assertEqual(append_db_ref(DBRef('users', _id, 'app'), docs), docs['app']['users'][_id])
+
+    def test_append_is_in_place(self):
+        data, ids = make_wide(10)
+        objects = data['objects']
+        self.assertIs(append_db_ref(data, make_docs(ids)), data)
+        self.assertIs(data['objects'], objects)
+
+    def test_deeper_than_recursion_limit(self):
+        data, ids = make_deep(5000)
+        self.assertEqual(len(collect_db_ref(data)), 5000)
+        append_db_ref(data, make_docs(ids))
+        self.assertEqual(data['items'][0]['ref'], {'_id': ids[1], 'name': 'user 1'})
+
+
+if __name__ == '__main__':
+    unittest.main()